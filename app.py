@@ -1,21 +1,41 @@
+import json
 import os
+import time
+from datetime import datetime
 
 import pyotp
+import requests
 from flask_babel import Babel, gettext as _
 from flask_admin import Admin
 from flask_admin.helpers import is_safe_url
 from flask_login import LoginManager, login_user, login_required, current_user, logout_user
 from flask_bootstrap import Bootstrap
-from flask import Flask, render_template, request, redirect, url_for, flash, abort
+from flask import Flask, render_template, request, redirect, url_for, flash, abort, Response, send_file, \
+    stream_with_context, jsonify, send_from_directory
 
-from extensions import db
-from models import User, Task, Tag, Changelog, Notice
+from extensions import db, user_cache, task_status_cache
+from models import User, Task, Tag, Changelog, Notice, DataVersion, RetryItem, DeadLetter
 from config import DevConfig, ProdConfig
-from forms import Login, TasksModelForm
+from forms import Login, TasksModelForm, ImportForm, BulkTasksForm, SearchForm
 from app_functions import scheduled_script
+from app_functions.assets import init_assets, get_assets_version
+from app_functions.bulk_tasks import edit_tasks
+from app_functions.checklist import parse_checklist
 from app_functions.cipher_functions import encrypt_text, init_cipher_key
+from app_functions.data_transfer import backup_database, export_user_data, import_user_data
+from app_functions.http_cache import init_http_cache, conditional
+from app_functions.jobs import MAINTENANCE_LEASE, start_job, get_job_status, is_job_due
+from app_functions.maintenance import run_maintenance
+from app_functions.planner import plan_run
+from app_functions.profiling import init_profiling, list_profiles
+from app_functions.recurrence import RULE_COMPLETION, RULE_INTERVAL, get_next_fire
+from app_functions.retry_queue import enqueue, is_retryable
+from app_functions.schema import sync_schema
+from app_functions.search import init_search, search_tasks
+from app_functions.statistics import get_statistics
+from app_functions.storage import init_storage, is_sqlite
 from app_functions.to_do_overs_data import ToDoOversData
-from views import MyView, MyAdminIndexView
+from views import MyView, MyAdminIndexView, UserView, TaskView, RetryItemView, DeadLetterView
 
 app = Flask(__name__)
 
@@ -25,8 +45,12 @@ else:
     app.config.from_object(DevConfig)
 
 db.app = app
-db.init_app(app)
-db.create_all()
+init_storage(app, db)
+sync_schema(db)
+init_search(db)
+
+user_cache.init_app(app, 'USER_CACHE_SIZE', 'USER_CACHE_TTL')
+task_status_cache.init_app(app, 'TASK_STATUS_CACHE_SIZE', 'TASK_STATUS_CACHE_TTL')
 
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -35,13 +59,19 @@ admin = Admin(app, index_view=MyAdminIndexView(
     name='首页',
     template='admin/index.html'
 ))
-admin.add_view(MyView(User, db.session))
-admin.add_view(MyView(Task, db.session))
+admin.add_view(UserView(User, db.session))
+admin.add_view(TaskView(Task, db.session))
 admin.add_view(MyView(Changelog, db.session))
 admin.add_view(MyView(Notice, db.session))
+admin.add_view(RetryItemView(RetryItem, db.session, name='重试队列'))
+admin.add_view(DeadLetterView(DeadLetter, db.session, name='失败任务'))
 
 bootstrap = Bootstrap(app)
 
+init_assets(app)
+init_http_cache(app, get_assets_version())
+init_profiling(app)
+
 babel = Babel(app)
 
 init_cipher_key()
@@ -70,6 +100,7 @@ def login():
                 next_url = request.args.get('next')
                 if next_url and not is_safe_url(next_url):
                     return abort(400)
+                user_cache.invalidate(session_class.hab_user_id)
                 user = User.query.get(session_class.hab_user_id)
                 login_user(user)
                 return redirect(next_url, url_for("dashboard"))
@@ -81,6 +112,7 @@ def login():
                 next_url = request.args.get('next')
                 if next_url and not is_safe_url(next_url):
                     return abort(400)
+                user_cache.invalidate(session_class.hab_user_id)
                 user = User.query.get(session_class.hab_user_id)
                 if request.form.get('remember-me'):
                     login_user(user, remember=True)
@@ -96,10 +128,21 @@ def login():
 
 
 @app.route('/dashboard', methods=['GET'])
+@conditional(lambda: dashboard_validators(), with_form=True)
 def dashboard():
     if current_user.is_authenticated:
-        tasks = Task.query.filter(Task.owner == current_user.id).all()
-        return render_template('dashboard.html', tasks=tasks)
+        tag_choices = [(tag.id, tag.tag_text) for tag in Tag.query.filter(Tag.tag_owner == current_user.id)]
+        search_form = SearchForm(request.args)
+        search_form.tags.choices = tag_choices
+        pagination = search_tasks(current_user.id, search_form.q.data, search_form.tags.data).paginate(
+            page=request.args.get('page', 1, type=int), per_page=app.config['TASKS_PER_PAGE'], error_out=False)
+        tasks = pagination.items
+        statuses = get_task_statuses(current_user)
+        task_states = {task.id: describe_task_status(task, statuses) for task in tasks}
+        bulk_form = BulkTasksForm()
+        bulk_form.tags.choices = tag_choices
+        return render_template('dashboard.html', tasks=tasks, task_states=task_states, bulk_form=bulk_form,
+                               search_form=search_form, pagination=pagination)
     else:
         flash(_('登录过期，请重新登录'))
         return redirect(url_for("index"))
@@ -129,13 +172,29 @@ def create_task():
                 task.delay = form.delay.data
                 task.priority = form.priority.data
                 task.owner = user_id
+                task.set_checklist(parse_checklist(form.checklist.data))
+                if not apply_task_rule(task, form):
+                    flash(_('重复规则不完整，请检查规则对应的日期或天数'))
+                    return redirect(url_for('create_task'))
                 tags = form.tags.data
                 task.tags = [Tag.query.get(tag) for tag in tags]
-                if session_class.create_task(user_id, api_token, task.name, task.notes, task.days, task.priority,
-                                             tags):
-                    task.id = session_class.task_id
+                # 子任务随创建请求一起发送，一次请求创建任务和所有子任务
+                if call_habitica(session_class.create_task, user_id, api_token, task.name, task.notes, task.days,
+                                 task.priority, tags, task.get_checklist()):
+                    task.set_habitica_id(session_class.task_id, checklist=session_class.checklist)
                     db.session.add(task)
                     db.session.commit()
+                    task_status_cache.invalidate(user_id)
+                    return redirect(url_for('dashboard'))
+                elif is_retryable(session_class.return_code):
+                    # Habitica 暂时不可用，交给定时任务的重试队列创建；本地的任务等创建成功后再保存
+                    task.tags = []
+                    if task in db.session:
+                        db.session.expunge(task)
+                    enqueue(user_id, 'create', payload=scheduled_script.get_create_payload(task, tags),
+                            error='create returned %s' % session_class.return_code)
+                    db.session.commit()
+                    flash(_('Habitica 暂时无法访问，任务已加入重试队列，稍后会自动创建'))
                     return redirect(url_for('dashboard'))
                 else:
                     flash('发生未知错误导致创建任务失败，请反馈')
@@ -157,8 +216,8 @@ def edit_task():
         choices = [(tag['id'], tag['name']) for tag in tags]
         form = TasksModelForm()
         form.tags.choices = choices
-        task_id = request.args['id']
-        task = Task.query.get(task_id)
+        task_id = request.args.get('id', type=int)
+        task = Task.query.get(task_id) if task_id else None
         if not task or user_id != task.owner:
             flash('警告：你没有对他人任务进行修改的权限！多次尝试可能会被禁止登陆')
             return redirect(url_for('dashboard'))
@@ -169,6 +228,11 @@ def edit_task():
             form.days.data = task.days
             form.delay.data = task.delay
             form.priority.data = task.priority
+            form.checklist.data = '\n'.join(task.get_checklist())
+            form.rule.data = task.rule or RULE_COMPLETION
+            form.rule_weekdays.data = [day for day in (task.rule_weekdays or '').split(',') if day]
+            form.rule_monthday.data = task.rule_monthday
+            form.rule_interval.data = task.rule_interval
             form.tags.default = task.tags
             return render_template('create_task.html', form=form)
         elif request.method == 'POST':
@@ -181,12 +245,38 @@ def edit_task():
                 task.delay = form.delay.data
                 task.priority = form.priority.data
                 task.owner = user_id
+                task.set_checklist(parse_checklist(form.checklist.data))
+                if not apply_task_rule(task, form):
+                    db.session.rollback()
+                    flash(_('重复规则不完整，请检查规则对应的日期或天数'))
+                    return redirect(url_for('edit_task', id=task_id))
                 tags = form.tags.data
                 task.tags = [Tag.query.get(tag) for tag in tags]
-                if session_class.edit_task(user_id, api_token, task.id, task.name, task.notes, task.days, task.priority,
-                                           tags):
+                edited = call_habitica(session_class.edit_task, user_id, api_token, task.habitica_id, task.name,
+                                       task.notes, task.days, task.priority, tags)
+                task_edited = edited
+                if edited:
+                    # 子任务只发送增加、删除和改名的部分；之后的请求失败时，已成功的部分也要记下来
+                    edited = call_habitica(session_class.edit_checklist, user_id, api_token, task.habitica_id,
+                                           task.instance.get_checklist(), task.get_checklist())
+                    task.instance.set_checklist(session_class.checklist)
+                if edited:
                     db.session.commit()
+                    task_status_cache.invalidate(user_id)
                     return redirect(url_for('dashboard'))
+                elif is_retryable(session_class.return_code):
+                    # 先保存修改，再由定时任务的重试队列同步到 Habitica
+                    enqueue(user_id, 'edit', task.id, error='edit returned %s' % session_class.return_code)
+                    db.session.commit()
+                    task_status_cache.invalidate(user_id)
+                    flash(_('Habitica 暂时无法访问，修改已保存并加入重试队列，稍后会自动同步'))
+                    return redirect(url_for('dashboard'))
+                elif task_edited:
+                    # Habitica 上的任务和部分子任务已经修改，保存实际的子任务，下次修改从这里开始比较
+                    db.session.commit()
+                    task_status_cache.invalidate(user_id)
+                    flash(_('任务已修改，但部分子任务同步失败，请重新提交'))
+                    return redirect(url_for('edit_task', id=task_id))
                 else:
                     flash('发生未知错误导致修改任务失败，请反馈')
                     return redirect(url_for('edit_task'))
@@ -201,8 +291,8 @@ def edit_task():
 def delete_task():
     if current_user.is_authenticated:
         user_id = current_user.id
-        task_id = request.args.get('id')
-        task = Task.query.get(task_id)
+        task_id = request.args.get('id', type=int)
+        task = Task.query.get(task_id) if task_id else None
         if not task or user_id != task.owner:
             flash('警告：你没有对他人任务进行修改的权限！多次尝试可能会被禁止登陆')
             return redirect(url_for('dashboard'))
@@ -215,7 +305,86 @@ def delete_task():
         return redirect(url_for("index"))
 
 
+@app.route('/bulk_tasks', methods=['POST'])
+def bulk_tasks():
+    if current_user.is_authenticated:
+        user_id = current_user.id
+        user_tags = {tag.id: tag for tag in Tag.query.filter(Tag.tag_owner == user_id)}
+        form = BulkTasksForm()
+        form.tags.choices = [(tag.id, tag.tag_text) for tag in user_tags.values()]
+        task_ids = request.form.getlist('task_ids', type=int)
+        if not task_ids or not form.validate_on_submit():
+            flash(_('请先选择要批量操作的任务'))
+            return redirect(url_for('dashboard'))
+        # 只能操作自己的任务
+        tasks = Task.query.filter(Task.owner == user_id, Task.id.in_(task_ids)).all()
+        results = []
+        if form.action.data == 'delete':
+            for task in tasks:
+                results.append((task.name, True, _('已删除')))
+                db.session.delete(task)
+            db.session.commit()
+        else:
+            edits = []
+            for task in tasks:
+                edits.append({
+                    'id': task.habitica_id,
+                    'name': task.name,
+                    'notes': task.notes,
+                    'days': task.days if form.days.data is None else form.days.data,
+                    'priority': form.priority.data or task.priority,
+                    'tags': form.tags.data if form.set_tags.data else [tag.id for tag in task.tags],
+                })
+            # 只修改延迟天数时不需要同步到 Habitica
+            if form.priority.data or form.days.data is not None or form.set_tags.data:
+                # 请求中只同步前 BULK_SYNC_LIMIT 个任务，其余的交给重试队列，避免请求长时间等待速率限制
+                sync_limit = app.config['BULK_SYNC_LIMIT']
+                synced = edit_tasks(user_id, current_user.api_token, edits[:sync_limit],
+                                    app.config['HABITICA_RATE_LIMIT'], app.config['HABITICA_RATE_PERIOD'],
+                                    app.config['BULK_MAX_WORKERS'])
+                synced.update({values['id']: (None, None) for values in edits[sync_limit:]})
+            else:
+                synced = {task.habitica_id: (True, 200) for task in tasks}
+            # 同步成功和稍后同步的任务在一个事务中修改
+            for task, values in zip(tasks, edits):
+                success, return_code = synced[task.habitica_id]
+                if success or success is None or is_retryable(return_code):
+                    task.days = values['days']
+                    task.priority = values['priority']
+                    if form.delay.data is not None:
+                        task.delay = form.delay.data
+                    if form.set_tags.data:
+                        task.tags = [user_tags[tag_id] for tag_id in values['tags']]
+                    if success:
+                        results.append((task.name, True, _('已修改')))
+                    elif success is None:
+                        enqueue(user_id, 'edit', task.id, error='bulk edit over BULK_SYNC_LIMIT')
+                        results.append((task.name, True, _('已修改，稍后同步到 Habitica')))
+                    else:
+                        enqueue(user_id, 'edit', task.id, error='edit returned %s' % return_code)
+                        results.append((task.name, True, _('已修改，稍后同步到 Habitica（%(code)s）', code=return_code)))
+                else:
+                    results.append((task.name, False, _('同步到 Habitica 失败（%(code)s）', code=return_code)))
+            db.session.commit()
+        task_status_cache.invalidate(user_id)
+        return render_template('bulk_result.html', results=results)
+    else:
+        flash(_('登录过期，请重新登录'))
+        return redirect(url_for("index"))
+
+
+@app.route('/statistics', methods=['GET'])
+@conditional(lambda: DataVersion.get_versions('stats:' + current_user.id) + [datetime.utcnow().date()])
+def statistics():
+    if current_user.is_authenticated:
+        return render_template('statistics.html', stats=get_statistics(current_user.id))
+    else:
+        flash(_('登录过期，请重新登录'))
+        return redirect(url_for("index"))
+
+
 @app.route('/about', methods=['GET'])
+@conditional(lambda: [])
 def about():
     if current_user.is_authenticated:
         return render_template('about.html')
@@ -225,6 +394,7 @@ def about():
 
 
 @app.route('/changelog', methods=['GET'])
+@conditional(lambda: DataVersion.get_versions('changelog'))
 def changelog():
     if current_user.is_authenticated:
         changelogs = Changelog.query.all()
@@ -246,9 +416,39 @@ def changelog():
 
 
 @app.route('/settings', methods=['GET'])
+@conditional(lambda: [], with_form=True)
 def settings():
     if current_user.is_authenticated:
-        return render_template('settings.html')
+        return render_template('settings.html', import_form=ImportForm())
+    else:
+        flash(_('登录过期，请重新登录'))
+        return redirect(url_for("index"))
+
+
+@app.route('/export', methods=['GET'])
+def export():
+    if current_user.is_authenticated:
+        filename = 'habitica-tasks-' + current_user.id + '.ndjson'
+        return Response(stream_with_context(export_user_data(current_user.id)),
+                        mimetype='application/x-ndjson',
+                        headers={'Content-Disposition': 'attachment; filename=' + filename})
+    else:
+        flash(_('登录过期，请重新登录'))
+        return redirect(url_for("index"))
+
+
+@app.route('/import', methods=['POST'])
+def import_data():
+    if current_user.is_authenticated:
+        form = ImportForm()
+        if form.validate_on_submit():
+            # 上传的文件较大时会被写入临时文件，这里逐行读取
+            result = import_user_data(current_user.id, form.file.data.stream)
+            task_status_cache.invalidate(current_user.id)
+            flash(_('导入完成：%(tags)d 个标签，%(tasks)d 个任务，跳过 %(skipped)d 行', **result))
+        else:
+            flash(_('导入失败，请选择要导入的文件'))
+        return redirect(url_for('settings'))
     else:
         flash(_('登录过期，请重新登录'))
         return redirect(url_for("index"))
@@ -260,6 +460,7 @@ def language():
         locale = request.args.get('locale')
         current_user.language = locale
         db.session.commit()
+        user_cache.invalidate(current_user.id)
         return redirect_back(url_for("language"))
     else:
         flash(_('登录过期，请重新登录'))
@@ -274,6 +475,7 @@ def set_role():
             if request.args.get('role') in User.ROLES:
                 current_user.role = request.args.get('role')
                 db.session.commit()
+                user_cache.invalidate(current_user.id)
                 flash('用户角色成功修改为' + request.args.get('role'))
                 return redirect(url_for("dashboard"))
             else:
@@ -296,11 +498,94 @@ def logout():
 def scheduled():
     if app.config['SCHEDULED_KEY']:
         if request.args.get('key') == app.config['SCHEDULED_KEY']:
-            scheduled_script.run()
-            return 'Success!'
+            # 在后台运行，租约保证所有实例中同时只有一个在运行
+            # 和请求的性能分析一样，只有管理员可以分析定时任务
+            profile_dir = app.config['PROFILE_DIR'] if app.config['PROFILING_ENABLED'] and request.args.get(
+                'profile') and current_user.role == 'admin' else None
+            job_id, started = start_job(app, scheduled_script.run, app.config['SCHEDULED_LEASE_TTL'],
+                                        app.config['SCHEDULED_HEARTBEAT_INTERVAL'], profile_dir,
+                                        app.config['PROFILE_INTERVAL'])
+            status_url = url_for('scheduled_status', job_id=job_id, key=request.args.get('key')) if job_id else None
+            if started:
+                result = {'job_id': job_id, 'status_url': status_url}
+                # 数据库维护和定时任务同时在后台运行，有自己的租约，每隔 MAINTENANCE_INTERVAL 秒运行一次
+                if is_job_due(MAINTENANCE_LEASE, app.config['MAINTENANCE_INTERVAL']):
+                    maintenance_job_id, maintenance_started = start_maintenance()
+                    if maintenance_started:
+                        result['maintenance_job_id'] = maintenance_job_id
+                        result['maintenance_status_url'] = url_for('scheduled_status', job_id=maintenance_job_id,
+                                                                   key=request.args.get('key'))
+                return jsonify(result), 202
+            return jsonify({'error': 'already running', 'job_id': job_id, 'status_url': status_url}), 409
+    abort(401)
+
+
+@app.route('/scheduled/maintenance', methods=['GET'])
+def scheduled_maintenance():
+    """立即运行一次数据库维护，结果在任务状态的 message 中；
+    加上 full=1 时运行完整的 VACUUM，旧数据库需要这样运行一次才能使用增量 VACUUM，期间会阻塞所有写入
+    """
+    if app.config['SCHEDULED_KEY']:
+        if request.args.get('key') == app.config['SCHEDULED_KEY']:
+            job_id, started = start_maintenance(full_vacuum=bool(request.args.get('full')))
+            status_url = url_for('scheduled_status', job_id=job_id, key=request.args.get('key')) if job_id else None
+            if started:
+                return jsonify({'job_id': job_id, 'status_url': status_url}), 202
+            return jsonify({'error': 'already running', 'job_id': job_id, 'status_url': status_url}), 409
+    abort(401)
+
+
+def start_maintenance(full_vacuum=False):
+    budget = app.config['MAINTENANCE_VACUUM_BUDGET']
+    return start_job(app, lambda: json.dumps(run_maintenance(budget, full_vacuum)), app.config['SCHEDULED_LEASE_TTL'],
+                     app.config['SCHEDULED_HEARTBEAT_INTERVAL'], lease=MAINTENANCE_LEASE)
+
+
+@app.route('/scheduled/plan', methods=['GET'])
+def scheduled_plan():
+    """预估下次定时任务的 Habitica 请求数、耗时和会重新创建的任务，不做任何写入
+    """
+    if app.config['SCHEDULED_KEY']:
+        if request.args.get('key') == app.config['SCHEDULED_KEY']:
+            return jsonify(plan_run(refresh=bool(request.args.get('refresh')),
+                                    rate=app.config['HABITICA_RATE_LIMIT'],
+                                    period=app.config['HABITICA_RATE_PERIOD'],
+                                    request_time=app.config['HABITICA_REQUEST_TIME'],
+                                    chunk_size=app.config['SCHEDULED_CHUNK_SIZE']))
+    abort(401)
+
+
+@app.route('/scheduled/<job_id>', methods=['GET'])
+def scheduled_status(job_id):
+    if app.config['SCHEDULED_KEY']:
+        if request.args.get('key') == app.config['SCHEDULED_KEY']:
+            status = get_job_status(job_id, app.config['SCHEDULED_LEASE_TTL'])
+            if status is None:
+                abort(404)
+            return jsonify(status)
     abort(401)
 
 
+@app.route('/profiles', methods=['GET'])
+@login_required
+def profiles():
+    if current_user.role != 'admin':
+        abort(401)
+    return jsonify([{'id': profile_id, 'url': url_for('download_profile', profile_id=profile_id)}
+                    for profile_id in list_profiles(app.config['PROFILE_DIR'])])
+
+
+@app.route('/profiles/<profile_id>', methods=['GET'])
+@login_required
+def download_profile(profile_id):
+    """下载性能分析结果，格式为折叠的调用栈，可直接用 flamegraph.pl 或 speedscope 打开
+    """
+    if current_user.role != 'admin':
+        abort(401)
+    return send_from_directory(os.path.abspath(app.config['PROFILE_DIR']), profile_id + '.folded',
+                               mimetype='text/plain', as_attachment=True)
+
+
 @app.route('/reset_database', methods=['GET'])
 def reset_database():
     """仅限开发阶段使用，请不要在发布阶段开启这样的危险命令
@@ -308,12 +593,37 @@ def reset_database():
     if app.config['ADMIN_KEY']:
         if request.args.get('key') == app.config['ADMIN_KEY']:
             if request.args.get('totp') == pyotp.TOTP(app.config['TOTP_SECRET']).now():
-                os.remove(app.config['SQLALCHEMY_DATABASE_PATH'])
+                db.session.remove()
+                if is_sqlite(db):
+                    # 先关闭连接池中的连接，否则它们还会写入已删除的文件
+                    db.engine.dispose()
+                    for suffix in ('', '-wal', '-shm'):
+                        if os.path.exists(app.config['SQLALCHEMY_DATABASE_PATH'] + suffix):
+                            os.remove(app.config['SQLALCHEMY_DATABASE_PATH'] + suffix)
+                else:
+                    db.drop_all()
                 db.create_all()
+                user_cache.clear()
                 return 'Success!'
     abort(401)
 
 
+@app.route('/backup_database', methods=['GET'])
+def backup():
+    """使用 SQLite 在线备份接口分批复制数据库，备份期间不影响正常读写
+    数据库服务器请使用服务器自带的备份工具
+    """
+    if not is_sqlite(db):
+        abort(404)
+    if app.config['ADMIN_KEY']:
+        if request.args.get('key') == app.config['ADMIN_KEY']:
+            if request.args.get('totp') == pyotp.TOTP(app.config['TOTP_SECRET']).now():
+                backup_path = backup_database(app.config['SQLALCHEMY_DATABASE_PATH'], app.config['BACKUP_DIR'],
+                                              keep=app.config['BACKUP_KEEP'])
+                return send_file(os.path.abspath(backup_path), as_attachment=True)
+    abort(401)
+
+
 # 函数功能，传入当前url 跳转回当前url的前一个url
 def redirect_back(back_url, **kwargs):
     for target in request.args.get('next'), request.referrer:
@@ -324,9 +634,92 @@ def redirect_back(back_url, **kwargs):
     return redirect(url_for(back_url, **kwargs))
 
 
+# 获取用户所有任务在 Habitica 上的状态，每个用户只请求一次列表接口，并短暂缓存
+def get_task_statuses(user):
+    statuses = task_status_cache.get(user.id)
+    if statuses is None:
+        session_class = ToDoOversData()
+        try:
+            statuses = session_class.get_user_task_status(user.id, user.api_token)
+        except requests.RequestException:
+            statuses = False
+        if statuses is False:
+            # Habitica 不可用时仪表盘照常显示，只是状态未知
+            return {}
+        task_status_cache.set(user.id, statuses)
+    return statuses
+
+
+# 把表单中的重复规则写入任务并计算下次创建的时间，规则不完整时返回 False
+def apply_task_rule(task, form):
+    task.rule = form.rule.data
+    task.rule_weekdays = ','.join(form.rule_weekdays.data or [])
+    task.rule_monthday = form.rule_monthday.data
+    task.rule_interval = form.rule_interval.data
+    if task.rule == RULE_COMPLETION:
+        task.next_fire = None
+        return True
+    if task.rule == RULE_INTERVAL and not task.rule_anchor:
+        task.rule_anchor = datetime.utcnow()
+    task.next_fire = get_next_fire(task, datetime.utcnow())
+    return task.next_fire is not None
+
+
+# 仪表盘依赖用户的任务和任务在 Habitica 上的状态
+def dashboard_validators():
+    statuses = get_task_statuses(current_user)
+    return DataVersion.get_versions('tasks:' + current_user.id) + [json.dumps(statuses, sort_keys=True)]
+
+
+# 调用 Habitica，没有收到响应时返回 False，调用对象的 return_code 为 0
+def call_habitica(method, *args):
+    try:
+        return method(*args)
+    except requests.RequestException:
+        method.__self__.return_code = 0
+        return False
+
+
+# 返回任务在仪表盘上显示的状态、状态颜色和下次重新创建的时间
+def describe_task_status(task, statuses):
+    status = statuses.get(task.habitica_id)
+    next_fire = task.next_fire.strftime('%Y-%m-%d') if task.next_fire else ''
+    if task.rule and task.rule != RULE_COMPLETION:
+        if status is None:
+            return _('未知'), 'secondary', next_fire
+        return (_('已完成'), 'success', next_fire) if status['completed'] else (_('进行中'), 'primary', next_fire)
+    if status is None:
+        return _('未知'), 'secondary', ''
+    if not status['completed']:
+        return _('进行中'), 'primary', ''
+    if task.delay == 0 or not status['dateCompleted']:
+        return _('已完成'), 'success', _('下次定时运行时')
+    recreate_date = scheduled_script.get_recreate_date(status['dateCompleted'], task.delay)
+    if recreate_date <= scheduled_script.get_utc_today():
+        return _('已完成'), 'success', _('下次定时运行时')
+    return _('延迟中'), 'warning', recreate_date.strftime('%Y-%m-%d')
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    # 缓存只在本进程内失效，其他 worker 修改用户时会增加数据版本号；
+    # 缓存的用户在 USER_CACHE_CHECK_INTERVAL 秒内不查询数据库，之后查询版本号，版本号不同时重新查询用户
+    cached = user_cache.get(user_id)
+    now = time.monotonic()
+    if cached is not None and now - cached[2] < app.config['USER_CACHE_CHECK_INTERVAL']:
+        return db.session.merge(cached[1], load=False)
+    version = DataVersion.get_versions('user:' + user_id)[0]
+    if cached is not None and cached[0] == version:
+        user = cached[1]
+    else:
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        # 缓存一个脱离会话的副本，请求中的提交不会让它过期
+        db.session.expunge(user)
+    user_cache.set(user_id, (version, user, now))
+    # 不查询数据库，直接把缓存的副本挂到当前会话上，对 current_user 的修改仍然可以提交
+    return db.session.merge(user, load=False)
 
 
 @babel.localeselector
@@ -0,0 +1,171 @@
+"""Static asset pipeline - Habitica To Do Over tool
+
+Serves Bootstrap, jQuery and the app's own static files locally under
+content-hashed names, with gzip/brotli variants built ahead of time,
+so browsers can cache them forever and never ask again.
+"""
+from __future__ import absolute_import
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+
+import flask_bootstrap
+from flask import abort, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:  # 没有安装 brotli 时只生成 gzip
+    brotli = None
+
+BOOTSTRAP_STATIC = os.path.join(os.path.dirname(flask_bootstrap.__file__), 'static')
+
+# 逻辑文件名 -> 按顺序拼接的源文件，(目录, 文件名)，目录为 None 时表示应用自己的 static 目录
+BUNDLES = {
+    'css/bootstrap.min.css': [(BOOTSTRAP_STATIC, 'css/bootstrap.min.css')],
+    'js/bundle.min.js': [(BOOTSTRAP_STATIC, 'jquery.min.js'), (BOOTSTRAP_STATIC, 'js/bootstrap.bundle.min.js')],
+    'css/signin.css': [(None, 'css/signin.css')],
+    'img/habitrpg_logo.png': [(None, 'img/habitrpg_logo.png')],
+    'img/tencent_logo.png': [(None, 'img/tencent_logo.png')],
+}
+
+COMPRESSIBLE_TYPES = ('text/css', 'application/javascript', 'text/javascript')
+
+_manifest = {}
+
+
+def _read_bundle(static_folder, sources):
+    parts = []
+    for directory, filename in sources:
+        with open(os.path.join(directory or static_folder, filename), 'rb') as source_file:
+            content = source_file.read()
+        if filename.endswith(('.js', '.css')):
+            # 拼接后的文件没有对应的 source map，去掉引用避免多余的请求
+            content = b'\n'.join(line for line in content.split(b'\n')
+                                 if not line.startswith((b'//# sourceMappingURL', b'/*# sourceMappingURL')))
+            content += b'\n;\n' if filename.endswith('.js') else b'\n'
+        parts.append(content)
+    return b''.join(parts)
+
+
+def build_assets(static_folder, assets_dir):
+    """Write every bundle with a content hash in its name.
+
+    Files that already exist are not rewritten, so this is cheap when
+    nothing has changed.
+
+    Args:
+        static_folder: The app's static folder.
+        assets_dir: Directory the hashed files are written to.
+
+    Returns:
+        Dict of logical name to hashed file name.
+    """
+    manifest = {}
+    for name, sources in BUNDLES.items():
+        content = _read_bundle(static_folder, sources)
+        digest = hashlib.sha256(content).hexdigest()[:12]
+        root, ext = os.path.splitext(name)
+        hashed_name = root + '.' + digest + ext
+        path = os.path.join(assets_dir, hashed_name)
+        if not os.path.exists(path):
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as asset_file:
+                asset_file.write(content)
+            if mimetypes.guess_type(name)[0] in COMPRESSIBLE_TYPES:
+                with open(path + '.gz', 'wb') as asset_file:
+                    asset_file.write(gzip.compress(content, 9))
+                if brotli is not None:
+                    with open(path + '.br', 'wb') as asset_file:
+                        asset_file.write(brotli.compress(content))
+        manifest[name] = hashed_name
+    with open(os.path.join(assets_dir, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest
+
+
+def _source_url(directory, filename):
+    if directory == BOOTSTRAP_STATIC:
+        return url_for('bootstrap.static', filename=filename)
+    return url_for('static', filename=filename)
+
+
+def asset_urls(name):
+    """Get the URLs of a static asset for templates.
+
+    Falls back to the unhashed source files, in bundle order, when the
+    assets were not built.
+
+    Returns:
+        List of URLs, one when the assets were built.
+    """
+    if name in _manifest:
+        return [url_for('asset', filename=_manifest[name])]
+    return [_source_url(directory, filename) for directory, filename in BUNDLES[name]]
+
+
+def asset_url(name):
+    """Get the URL of a single file static asset for templates.
+
+    Use asset_urls for bundles of several files, they have no single
+    URL when the assets were not built.
+
+    Raises:
+        ValueError: If name is a bundle of several files that was not built.
+    """
+    urls = asset_urls(name)
+    if len(urls) != 1:
+        raise ValueError(name + ' was not built and has several files, use asset_urls')
+    return urls[0]
+
+
+def get_assets_version():
+    """Get a version string that changes whenever an asset changes."""
+    return ','.join(sorted(_manifest.values()))
+
+
+def init_assets(app):
+    """Build the assets and register the asset route and template helper.
+
+    Args:
+        app: The Flask app.
+    """
+    assets_dir = os.path.join(app.root_path, app.config['ASSETS_DIR'])
+    max_age = app.config['ASSETS_MAX_AGE']
+
+    try:
+        _manifest.update(build_assets(app.static_folder, assets_dir))
+    except OSError as e:
+        print('asset build failed, serving unhashed files: ' + str(e))
+
+    @app.route('/assets/<path:filename>')
+    def asset(filename):
+        if filename not in _manifest.values():
+            abort(404)
+        mimetype = mimetypes.guess_type(filename)[0]
+        encoding = None
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if candidate in request.accept_encodings and os.path.exists(
+                    os.path.join(assets_dir, filename + suffix)):
+                encoding = candidate
+                filename += suffix
+                break
+        response = send_from_directory(assets_dir, filename, mimetype=mimetype, max_age=max_age)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % max_age
+        response.vary.add('Accept-Encoding')
+        return response
+
+    @app.cli.command('build-assets')
+    def build_assets_command():
+        """Build the hashed static assets."""
+        manifest = build_assets(app.static_folder, assets_dir)
+        for name, hashed_name in manifest.items():
+            print(name + ' -> ' + hashed_name)
+
+    app.jinja_env.globals['asset_url'] = asset_url
+    app.jinja_env.globals['asset_urls'] = asset_urls
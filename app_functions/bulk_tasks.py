@@ -0,0 +1,46 @@
+"""Bulk task operations - Habitica To Do Over tool
+
+Sends edits of many tasks to Habitica concurrently, while staying under
+the user's rate limit.
+"""
+from __future__ import absolute_import
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .rate_limit import get_limiter
+from .to_do_overs_data import ToDoOversData
+
+
+def edit_tasks(user_id, api_token, edits, rate=30, period=60, max_workers=8):
+    """Edit many tasks on Habitica concurrently.
+
+    Args:
+        user_id: Habitica user ID.
+        api_token: The user's encrypted API token.
+        edits: List of dicts with id (the Habitica ID), name, notes, days,
+            priority and tags.
+        rate: Number of requests allowed per period for the user.
+        period: Length of the rate limit period in seconds.
+        max_workers: Max number of requests in flight.
+
+    Returns:
+        Dict of task ID to (success, return_code).
+    """
+    limiter = get_limiter(user_id, rate, period)
+
+    def edit(values):
+        limiter.acquire()
+        tdo_data = ToDoOversData()
+        try:
+            success = tdo_data.edit_task(user_id, api_token, values['id'], values['name'], values['notes'],
+                                         values['days'], values['priority'], values['tags'])
+        except requests.RequestException:
+            return values['id'], False, 0
+        return values['id'], success, tdo_data.return_code
+
+    if not edits:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(edits))) as executor:
+        return {task_id: (success, return_code) for task_id, success, return_code in executor.map(edit, edits)}
@@ -0,0 +1,73 @@
+"""In-process caches - Habitica To Do Over tool
+
+Small thread-safe caches shared by the web workers.
+"""
+from __future__ import absolute_import
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """A bounded LRU cache whose entries expire after a fixed time.
+
+    Attributes:
+        max_size (int): Max number of entries kept, the least recently
+            used entry is evicted first.
+        ttl (float): Seconds an entry stays valid after it was stored.
+    """
+
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app, size_key, ttl_key):
+        """Read the size and TTL from the app config.
+
+        Args:
+            app: The Flask app.
+            size_key: Config key of the max size.
+            ttl_key: Config key of the TTL in seconds.
+        """
+        self.max_size = app.config.get(size_key, self.max_size)
+        self.ttl = app.config.get(ttl_key, self.ttl)
+
+    def get(self, key, default=None):
+        """Get a value if it is present and not expired.
+
+        Returns:
+            The cached value, or default on a miss.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expire_at, value = item
+            if expire_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Store a value, evicting the oldest entries if needed."""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        """Drop one entry."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Drop every entry."""
+        with self._lock:
+            self._data.clear()
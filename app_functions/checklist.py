@@ -0,0 +1,55 @@
+"""Checklists - Habitica To Do Over tool
+
+A task template keeps the texts of its checklist items, and its current
+Habitica instance keeps the IDs and texts of the items Habitica has.
+New instances get the whole checklist inline in the create request. An
+edit compares the two and only sends the items that were added, removed
+or renamed.
+"""
+from __future__ import absolute_import
+
+from collections import Counter
+
+
+def parse_checklist(text):
+    """Get the checklist items of the form's text, one per non-empty line."""
+    return [line.strip() for line in (text or '').splitlines() if line.strip()]
+
+
+def get_checklist_diff(items, texts):
+    """Get the changes that turn Habitica's checklist into texts.
+
+    Habitica can't move checklist items, so the order is not compared:
+    items whose text is still wanted are kept wherever they are, and
+    their completion state stays. A checklist that was only reordered
+    needs no request. The other items are renamed in order, then the
+    rest is removed or added. Habitica appends added items at the end,
+    a recreated task gets the template's order again.
+
+    Args:
+        items: List of {'id', 'text'} of the Habitica checklist.
+        texts: The wanted item texts.
+
+    Returns:
+        Tuple of the renames as (item ID, text), the item IDs to remove
+        and the texts to add.
+    """
+    wanted = Counter(texts)
+    old_items = []
+    for item in items:
+        if wanted[item['text']] > 0:
+            wanted[item['text']] -= 1
+        else:
+            old_items.append(item)
+    kept = Counter(texts)
+    kept.subtract(wanted)
+    new_texts = []
+    for text in texts:
+        if kept[text] > 0:
+            kept[text] -= 1
+        else:
+            new_texts.append(text)
+    renames = [(item['id'], text) for item, text in zip(old_items, new_texts)]
+    removes = [item['id'] for item in old_items[len(new_texts):]]
+    adds = new_texts[len(old_items):]
+    return renames, removes, adds
@@ -0,0 +1,293 @@
+"""Data management functions - Habitica To Do Over tool
+
+Online database backup and per-user export/import of tasks and tags.
+Exports are NDJSON, one tag or task per line, so both directions can
+stream without loading whole tables.
+"""
+from __future__ import absolute_import
+
+import json
+import os
+import sqlite3
+from datetime import datetime
+
+from extensions import db
+from models import Tag, Task, TaskInstance, task_tag
+from .recurrence import RULE_COMPLETION, RULE_INTERVAL, RULE_MONTHLY, RULE_WEEKLY, get_next_fire
+from .scheduled_script import DATETIME_FORMAT
+
+
+def backup_database(database_path, backup_dir, pages=256, sleep=0.05, keep=7):
+    """Copy the live SQLite database with the online backup API.
+
+    The copy is made a few pages at a time, and other connections can
+    keep reading and writing between the steps. The copy is written to a
+    .part file, renamed when it's complete and deleted when it fails
+    partway. After a successful copy only the newest keep backups are
+    left in backup_dir.
+
+    Args:
+        database_path: Path of the live database.
+        backup_dir: Directory the backup file is written to.
+        pages: Number of pages copied per step.
+        sleep: Seconds to sleep between steps.
+        keep: Number of backups to keep, 0 keeps all of them.
+
+    Returns:
+        The path of the backup file.
+    """
+    if not os.path.exists(backup_dir):
+        os.makedirs(backup_dir)
+    backup_path = os.path.join(
+        backup_dir, 'habitica-' + datetime.utcnow().strftime('%Y%m%d%H%M%S') + '.sqlite'
+    )
+    part_path = backup_path + '.part'
+    source = sqlite3.connect(database_path)
+    target = sqlite3.connect(part_path)
+    try:
+        source.backup(target, pages=pages, sleep=sleep)
+        target.close()
+        os.replace(part_path, backup_path)
+    except Exception:
+        target.close()
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    finally:
+        source.close()
+    if keep:
+        prune_backups(backup_dir, keep)
+    return backup_path
+
+
+def prune_backups(backup_dir, keep):
+    """Delete all but the newest keep backups in backup_dir.
+
+    Returns:
+        The paths of the deleted files.
+    """
+    # The timestamp in the name sorts the backups by age
+    names = sorted(name for name in os.listdir(backup_dir)
+                   if name.startswith('habitica-') and name.endswith('.sqlite'))
+    deleted = [os.path.join(backup_dir, name) for name in names[:-keep]]
+    for path in deleted:
+        os.remove(path)
+    return deleted
+
+
+def export_user_data(user_id, chunk_size=500):
+    """Export a user's tags and tasks as NDJSON lines.
+
+    Tasks are read in chunks ordered by ID, and the tag links of each
+    chunk are fetched with one query.
+
+    Args:
+        user_id: The user to export.
+        chunk_size: Number of rows read per query.
+
+    Yields:
+        One JSON document per line.
+    """
+    for tag in Tag.query.filter(Tag.tag_owner == user_id).order_by(Tag.id).yield_per(chunk_size):
+        yield json.dumps({'type': 'tag', 'id': tag.id, 'name': tag.tag_text}, ensure_ascii=False) + '\n'
+
+    last_id = 0
+    while True:
+        tasks = Task.query.filter(Task.owner == user_id, Task.id > last_id) \
+            .order_by(Task.id).limit(chunk_size).all()
+        if not tasks:
+            break
+        task_ids = [task.id for task in tasks]
+        links = db.session.execute(
+            db.select([task_tag.c.task_id, task_tag.c.tag_id]).where(task_tag.c.task_id.in_(task_ids))
+        )
+        tags = {}
+        for task_id, tag_id in links:
+            tags.setdefault(task_id, []).append(tag_id)
+        for task in tasks:
+            yield json.dumps({
+                'type': 'task',
+                'habitica_id': task.habitica_id,
+                'name': task.name,
+                'notes': task.notes,
+                'priority': task.priority,
+                'days': task.days,
+                'delay': task.delay,
+                'checklist': task.get_checklist(),
+                'rule': task.rule or RULE_COMPLETION,
+                'rule_weekdays': task.rule_weekdays,
+                'rule_monthday': task.rule_monthday,
+                'rule_interval': task.rule_interval,
+                'rule_anchor': task.rule_anchor.strftime(DATETIME_FORMAT) if task.rule_anchor else None,
+                'tags': tags.get(task.id, []),
+            }, ensure_ascii=False) + '\n'
+        last_id = task_ids[-1]
+
+
+def _is_count(value):
+    # bool is an int too
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def _is_text_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
+def _get_rule_values(row):
+    # Rules must be complete, like the task form requires, or the task would never be created again
+    values = {
+        'rule': row.get('rule') or RULE_COMPLETION,
+        'rule_weekdays': row.get('rule_weekdays') or None,
+        'rule_monthday': row.get('rule_monthday'),
+        'rule_interval': row.get('rule_interval'),
+        'rule_anchor': row.get('rule_anchor'),
+    }
+    if values['rule'] not in Task.RULES:
+        return None
+    weekdays = values['rule_weekdays']
+    if weekdays is not None and (not isinstance(weekdays, str) or
+                                 not set(weekdays.split(',')) <= set('0123456')):
+        return None
+    if values['rule_monthday'] is not None and (not _is_count(values['rule_monthday'])
+                                                or not 1 <= values['rule_monthday'] <= 31):
+        return None
+    if values['rule_interval'] is not None and (not _is_count(values['rule_interval'])
+                                                or values['rule_interval'] < 1):
+        return None
+    if values['rule_anchor'] is not None:
+        try:
+            values['rule_anchor'] = datetime.strptime(values['rule_anchor'], DATETIME_FORMAT)
+        except (TypeError, ValueError):
+            return None
+    required = {RULE_WEEKLY: 'rule_weekdays', RULE_MONTHLY: 'rule_monthday', RULE_INTERVAL: 'rule_interval'}
+    if values['rule'] in required and values[required[values['rule']]] is None:
+        return None
+    return values
+
+
+def _get_task_values(row):
+    """Get the task fields of an import row, checked like the task form does.
+
+    Returns:
+        Dict of the fields, or None if a field is invalid.
+    """
+    values = {
+        'name': row.get('name'),
+        'notes': row.get('notes'),
+        'priority': row.get('priority', '1.0'),
+        'days': row.get('days', 0),
+        'delay': row.get('delay', 0),
+        'checklist': row.get('checklist') or [],
+        'tags': row.get('tags') or [],
+    }
+    if not all(isinstance(values[key], str) or values[key] is None for key in ('name', 'notes')):
+        return None
+    if not isinstance(values['priority'], str) or values['priority'] not in Task.PRIORITY_CHOICES:
+        return None
+    if not _is_count(values['days']) or not _is_count(values['delay']):
+        return None
+    if not _is_text_list(values['checklist']) or not _is_text_list(values['tags']):
+        return None
+    rule_values = _get_rule_values(row)
+    if rule_values is None:
+        return None
+    values.update(rule_values)
+    return values
+
+
+def import_user_data(user_id, lines, batch_size=500):
+    """Import NDJSON lines produced by export_user_data for a user.
+
+    Tasks are matched by their Habitica ID. Files exported before tasks
+    had stable IDs, which carry the Habitica ID in 'id', are accepted,
+    and so are files without rules, whose tasks are recreated after
+    completion. The next fire time of rule tasks is computed again.
+
+    Rows are upserted and committed in batches. Every row is owned by
+    user_id, whatever the file says, and rows owned by another user
+    are skipped, as are rows with missing or invalid fields.
+
+    Args:
+        user_id: The user the data is imported to.
+        lines: Iterable of NDJSON lines (str or bytes).
+        batch_size: Number of rows per transaction.
+
+    Returns:
+        Dict with the number of imported tags, tasks and skipped lines.
+    """
+    result = {'tags': 0, 'tasks': 0, 'skipped': 0}
+    pending = 0
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            result['skipped'] += 1
+            continue
+        if not isinstance(row, dict):
+            result['skipped'] += 1
+            continue
+
+        if row.get('type') == 'tag':
+            if not row.get('id') or not isinstance(row['id'], str):
+                result['skipped'] += 1
+                continue
+            tag = Tag.query.get(row['id'])
+            if tag is None:
+                tag = Tag(id=row['id'], tag_owner=user_id)
+                db.session.add(tag)
+            elif tag.tag_owner != user_id:
+                result['skipped'] += 1
+                continue
+            tag.tag_text = row.get('name') if isinstance(row.get('name'), str) else None
+            result['tags'] += 1
+        elif row.get('type') == 'task':
+            # 旧版本导出的文件用 id 保存 Habitica 的任务 ID
+            habitica_id = row.get('habitica_id') or row.get('id')
+            values = _get_task_values(row)
+            if not habitica_id or not isinstance(habitica_id, str) or values is None:
+                result['skipped'] += 1
+                continue
+            instance = TaskInstance.query.filter(TaskInstance.habitica_id == habitica_id).first()
+            task = instance.task if instance else None
+            if task is None:
+                task = Task(owner=user_id)
+                task.set_habitica_id(habitica_id)
+                db.session.add(task)
+            elif task.owner != user_id:
+                result['skipped'] += 1
+                continue
+            task.name = values['name']
+            task.notes = values['notes']
+            task.priority = values['priority']
+            task.days = values['days']
+            task.delay = values['delay']
+            task.set_checklist(values['checklist'])
+            for key in ('rule', 'rule_weekdays', 'rule_monthday', 'rule_interval', 'rule_anchor'):
+                setattr(task, key, values[key])
+            if task.rule == RULE_INTERVAL and not task.rule_anchor:
+                task.rule_anchor = datetime.utcnow()
+            # 和编辑任务一样重新计算下次创建的时间，完成后重新创建的任务为空
+            task.next_fire = get_next_fire(task, datetime.utcnow())
+            db.session.flush()
+            db.session.execute(task_tag.delete().where(task_tag.c.task_id == task.id))
+            tag_ids = [tag.id for tag in Tag.query.filter(Tag.id.in_(values['tags']),
+                                                          Tag.tag_owner == user_id)]
+            if tag_ids:
+                db.session.execute(task_tag.insert(), [{'task_id': task.id, 'tag_id': tag_id} for tag_id in tag_ids])
+            result['tasks'] += 1
+        else:
+            result['skipped'] += 1
+            continue
+
+        pending += 1
+        if pending >= batch_size:
+            # 会话的标识映射是弱引用，提交后已处理的行会被回收，内存占用不随文件大小增长
+            db.session.commit()
+            pending = 0
+    db.session.commit()
+    return result
@@ -0,0 +1,116 @@
+"""HTTP caching and compression - Habitica To Do Over tool
+
+Conditional responses for the dynamic pages, and gzip/brotli
+compression of large text responses.
+"""
+from __future__ import absolute_import
+
+import gzip
+import hashlib
+import os
+import time
+from functools import wraps
+
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+
+try:
+    import brotli
+except ImportError:  # 没有安装 brotli 时只使用 gzip
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('text/html', 'text/plain', 'text/css', 'application/json', 'application/javascript')
+
+_build_id = ''
+
+
+def _hash(parts):
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def conditional(get_validators, with_form=False):
+    """Answer If-None-Match with 304 before the view renders.
+
+    The ETag is built from the values returned by get_validators, plus
+    the logged-in user, the locale and the deployed templates and assets.
+    Anonymous requests and pages with pending flash messages are always
+    rendered.
+
+    Args:
+        get_validators: Function returning a list of data versions the
+            page depends on.
+        with_form: The page has a CSRF token, so the ETag also changes
+            before the token expires.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not current_user.is_authenticated or session.get('_flashes'):
+                return view(*args, **kwargs)
+            parts = [_build_id, request.full_path, current_user.id, current_user.username, current_user.role,
+                     current_user.language] + list(get_validators())
+            if with_form:
+                parts.append(int(time.time() // (current_app.config['WTF_CSRF_TIME_LIMIT'] / 2)))
+            etag = _hash(parts)
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
+
+
+def compress_response(response):
+    """Compress a large text response with brotli or gzip.
+
+    Registered as an after_request hook.
+    """
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    data = response.get_data()
+    if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+    if brotli is not None and 'br' in request.accept_encodings:
+        response.set_data(brotli.compress(data, quality=current_app.config['COMPRESS_LEVEL']))
+        response.headers['Content-Encoding'] = 'br'
+    elif 'gzip' in request.accept_encodings:
+        response.set_data(gzip.compress(data, current_app.config['COMPRESS_LEVEL']))
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        return response
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_http_cache(app, assets_version=''):
+    """Register compression and compute the build ID used in ETags.
+
+    The build ID changes when a template or asset changes, so a deploy
+    invalidates every cached page.
+
+    Args:
+        app: The Flask app.
+        assets_version: Version of the static assets.
+    """
+    global _build_id
+    parts = [assets_version]
+    template_folder = os.path.join(app.root_path, app.template_folder)
+    for root, dirs, files in sorted(os.walk(template_folder)):
+        for filename in sorted(files):
+            with open(os.path.join(root, filename), 'rb') as template_file:
+                parts.append(hashlib.sha1(template_file.read()).hexdigest())
+    _build_id = _hash(parts)
+    app.config.setdefault('WTF_CSRF_TIME_LIMIT', 3600)
+    app.after_request(compress_response)
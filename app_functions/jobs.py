@@ -0,0 +1,268 @@
+"""Background jobs - Habitica To Do Over tool
+
+Runs the scheduled script and the database maintenance in background
+threads. A lease row in the database per kind of job, renewed by a
+heartbeat, makes sure that at most one run of each is active across all
+instances. A lease whose holder stopped sending heartbeats expires and
+can be taken over.
+
+A job that could not renew its lease for half the TTL gives it up: its
+next check_lease() call stops it. Jobs call it between units of work and
+before every Habitica request, so the other half of the TTL only has to
+cover one request, see HABITICA_TIMEOUT, which must stay well below it.
+"""
+from __future__ import absolute_import
+
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db
+from models import JobLease, ScheduledJob
+from .profiling import Sampler, save_profile
+
+SCHEDULED_LEASE = 'scheduled'
+MAINTENANCE_LEASE = 'maintenance'
+
+# Seconds between attempts to renew a lease after a failed heartbeat
+HEARTBEAT_RETRY_INTERVAL = 1
+
+# Job threads of this process, so shutdown can wait for them
+_job_threads = set()
+# The lease lost event of the job running in the current thread
+_current_job = threading.local()
+
+
+class LeaseLost(Exception):
+    """Raised by check_lease in a job whose lease was lost."""
+
+
+def acquire_lease(name, holder, ttl):
+    """Take a lease if it is free or expired.
+
+    Args:
+        name: Name of the lease.
+        holder: ID of the new holder.
+        ttl: Seconds the lease is valid without a heartbeat.
+
+    Returns:
+        True if the lease was taken, False if someone else holds it.
+    """
+    now = datetime.utcnow()
+    table = JobLease.__table__
+    with db.engine.begin() as connection:
+        updated = connection.execute(
+            table.update()
+            .where(table.c.name == name)
+            .where(or_(table.c.expires_at < now, table.c.holder == holder))
+            .values(holder=holder, expires_at=now + timedelta(seconds=ttl), heartbeat_at=now)
+        ).rowcount
+    if updated:
+        return True
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(table.insert().values(
+                name=name, holder=holder, expires_at=now + timedelta(seconds=ttl), heartbeat_at=now))
+        return True
+    except IntegrityError:
+        return False
+
+
+def renew_lease(name, holder, ttl):
+    """Extend a lease held by holder.
+
+    Returns:
+        False if the lease was lost to someone else.
+    """
+    now = datetime.utcnow()
+    table = JobLease.__table__
+    with db.engine.begin() as connection:
+        return connection.execute(
+            table.update()
+            .where(table.c.name == name)
+            .where(table.c.holder == holder)
+            .values(expires_at=now + timedelta(seconds=ttl), heartbeat_at=now)
+        ).rowcount == 1
+
+
+def release_lease(name, holder):
+    """Give a lease back so the next run can start right away."""
+    table = JobLease.__table__
+    with db.engine.begin() as connection:
+        connection.execute(
+            table.update()
+            .where(table.c.name == name)
+            .where(table.c.holder == holder)
+            .values(expires_at=datetime.utcnow())
+        )
+
+
+def check_lease():
+    """Stop the current job if it lost its lease.
+
+    Long running jobs call this between units of work, e.g. between
+    tasks, so that a job that could not renew its lease stops before
+    another run takes it over. Outside a job it does nothing.
+
+    Raises:
+        LeaseLost: If the lease was lost.
+    """
+    lease_lost = getattr(_current_job, 'lease_lost', None)
+    if lease_lost is not None and lease_lost.is_set():
+        raise LeaseLost('lost the lease, stopping')
+
+
+def get_lease_holder(name):
+    """Get the holder of a lease that has not expired, or None."""
+    lease = JobLease.query.get(name)
+    if lease and lease.expires_at and lease.expires_at > datetime.utcnow():
+        return lease.holder
+    return None
+
+
+def _run_job(app, lease, job_id, target, ttl, heartbeat_interval, profile_dir, profile_interval):
+    stopped = threading.Event()
+    lease_lost = threading.Event()
+
+    def heartbeat():
+        renewed_at = time.time()
+        wait = heartbeat_interval
+        with app.app_context():
+            while not stopped.wait(wait):
+                attempt_at = time.time()
+                try:
+                    renewed = renew_lease(lease, job_id, ttl)
+                except Exception:
+                    # E.g. database is locked, try again while more than half the TTL is left
+                    print('could not renew the lease of job ' + job_id + '\n' + traceback.format_exc())
+                    if time.time() - renewed_at + HEARTBEAT_RETRY_INTERVAL < ttl / 2.0:
+                        wait = HEARTBEAT_RETRY_INTERVAL
+                        continue
+                    renewed = False
+                if not renewed:
+                    print('lost the lease of job ' + job_id)
+                    lease_lost.set()
+                    return
+                # The new expiry time was computed during the attempt
+                renewed_at = attempt_at
+                wait = heartbeat_interval
+                table = ScheduledJob.__table__
+                try:
+                    with db.engine.begin() as connection:
+                        connection.execute(table.update().where(table.c.id == job_id)
+                                           .values(heartbeat_at=datetime.utcnow()))
+                except Exception:
+                    # Only the job's status page uses it, the lease is what counts
+                    print('could not record the heartbeat of job ' + job_id + '\n' + traceback.format_exc())
+
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    _current_job.lease_lost = lease_lost
+
+    with app.app_context():
+        status, message = 'succeeded', None
+        try:
+            if profile_dir:
+                with Sampler(interval=profile_interval) as sampler:
+                    message = target()
+                message = '\n'.join(filter(None, [
+                    message, 'profile ' + save_profile(profile_dir, lease + '-' + job_id, sampler)]))
+            else:
+                message = target()
+        except LeaseLost:
+            status, message = 'lost', 'stopped after losing the lease'
+            print('job ' + job_id + ' ' + message)
+        except Exception:
+            status, message = 'failed', traceback.format_exc()
+            print(message)
+        finally:
+            _current_job.lease_lost = None
+            stopped.set()
+            heartbeat_thread.join()
+            db.session.rollback()
+            job = ScheduledJob.query.get(job_id)
+            job.status = status
+            job.message = message
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+            release_lease(lease, job_id)
+            db.session.remove()
+            _job_threads.discard(threading.current_thread())
+
+
+def start_job(app, target, ttl=120, heartbeat_interval=30, profile_dir=None, profile_interval=0.005,
+              lease=SCHEDULED_LEASE):
+    """Start target in a background thread if no other run is active.
+
+    Args:
+        app: The Flask app, the job runs in its app context.
+        target: Function to run. What it returns, if anything, is saved
+            as the job's message.
+        ttl: Seconds the lease is valid without a heartbeat.
+        heartbeat_interval: Seconds between heartbeats, must be well
+            below ttl.
+        profile_dir: If set, the run is profiled and the profile is
+            saved there as <lease>-<job_id>.
+        profile_interval: Seconds between profile samples.
+        lease: Name of the lease, and of the job.
+
+    Returns:
+        (job_id, True) if the job was started, or (ID of the active
+        job, False) if another run holds the lease.
+    """
+    job_id = uuid.uuid4().hex
+    if not acquire_lease(lease, job_id, ttl):
+        return get_lease_holder(lease), False
+
+    now = datetime.utcnow()
+    db.session.add(ScheduledJob(id=job_id, name=lease, status='running', started_at=now, heartbeat_at=now))
+    db.session.commit()
+
+    thread = threading.Thread(target=_run_job, args=(app, lease, job_id, target, ttl, heartbeat_interval,
+                                                     profile_dir, profile_interval), daemon=True)
+    _job_threads.add(thread)
+    thread.start()
+    return job_id, True
+
+
+def wait_for_jobs(timeout):
+    """Wait for the jobs started by this process to finish.
+
+    Used on graceful shutdown. A job still running after the timeout is
+    abandoned, its lease expires and the next run takes over.
+
+    Returns:
+        True if no job is running anymore.
+    """
+    deadline = time.time() + timeout
+    for thread in list(_job_threads):
+        thread.join(max(0, deadline - time.time()))
+        if not thread.is_alive():
+            _job_threads.discard(thread)
+    return not _job_threads
+
+
+def is_job_due(name, interval):
+    """Whether the last successful job called name finished more than interval seconds ago."""
+    last = db.session.query(db.func.max(ScheduledJob.finished_at)).filter(
+        ScheduledJob.name == name, ScheduledJob.status == 'succeeded').scalar()
+    return last is None or last < datetime.utcnow() - timedelta(seconds=interval)
+
+
+def get_job_status(job_id, ttl=120):
+    """Get the status of a job as a dict, or None if it doesn't exist.
+
+    A running job that stopped sending heartbeats is reported as lost.
+    """
+    job = ScheduledJob.query.get(job_id)
+    if job is None:
+        return None
+    status = job.to_dict()
+    if job.status == 'running' and job.heartbeat_at < datetime.utcnow() - timedelta(seconds=ttl):
+        status['status'] = 'lost'
+    return status
@@ -0,0 +1,155 @@
+"""Database maintenance - Habitica To Do Over tool
+
+Keeps the database from only growing. A maintenance run
+
+1. purges orphaned rows in bulk: tasks of deleted users, instances,
+   tag links and queued operations of deleted tasks, tags of deleted
+   users and links to deleted tags,
+2. refreshes the query planner statistics with ANALYZE,
+3. gives free SQLite pages back to the file system with an incremental
+   vacuum, a few pages at a time until the time budget is used up, so
+   other connections only ever wait for one small step.
+
+New SQLite files are created with auto_vacuum=INCREMENTAL, see
+app_functions/storage.py. Older files need one full VACUUM to switch,
+which rewrites the whole file and is only run on request.
+"""
+from __future__ import absolute_import
+
+import time
+
+from sqlalchemy import or_, select
+
+from extensions import db
+from .jobs import check_lease
+from models import DeadLetter, RetryItem, Tag, Task, TaskInstance, User, task_tag
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def purge_orphans():
+    """Delete rows whose parent row is gone, one statement per kind.
+
+    Returns:
+        Dict of kind to the number of deleted rows.
+    """
+    statements = [
+        ('tasks', Task.__table__.delete().where(~Task.__table__.c.owner.in_(select(User.__table__.c.id)))),
+        ('task_instances', TaskInstance.__table__.delete().where(
+            ~TaskInstance.__table__.c.task_id.in_(select(Task.__table__.c.id)))),
+        ('retry_items', RetryItem.__table__.delete().where(
+            ~RetryItem.__table__.c.task_id.in_(select(Task.__table__.c.id)))),
+        ('dead_letters', DeadLetter.__table__.delete().where(
+            ~DeadLetter.__table__.c.task_id.in_(select(Task.__table__.c.id)))),
+        ('tags', Tag.__table__.delete().where(or_(Tag.__table__.c.tag_owner.is_(None),
+                                                  ~Tag.__table__.c.tag_owner.in_(select(User.__table__.c.id))))),
+        ('task_tags', task_tag.delete().where(or_(~task_tag.c.task_id.in_(select(Task.__table__.c.id)),
+                                                  ~task_tag.c.tag_id.in_(select(Tag.__table__.c.id))))),
+    ]
+    purged = {}
+    for kind, statement in statements:
+        check_lease()
+        with db.engine.begin() as connection:
+            purged[kind] = connection.execute(statement).rowcount
+    return purged
+
+
+def analyze():
+    """Refresh the statistics the query planner and the admin's estimated counts use.
+
+    Returns:
+        True if the database supports it.
+    """
+    dialect = db.engine.dialect.name
+    with db.engine.begin() as connection:
+        if dialect in ('sqlite', 'postgresql'):
+            connection.exec_driver_sql('ANALYZE')
+        elif dialect == 'mysql':
+            connection.exec_driver_sql('ANALYZE TABLE ' + ', '.join(db.metadata.tables))
+        else:
+            return False
+    return True
+
+
+def vacuum(budget=10, step_pages=256, full=False):
+    """Give free SQLite pages back to the file system.
+
+    Args:
+        budget: Max seconds of incremental vacuum. A step that started
+            within the budget is finished.
+        step_pages: Pages freed per step, each step is a short write
+            transaction.
+        full: Run a full VACUUM instead, which rewrites the file and
+            switches it to incremental auto vacuum. It takes as long as
+            it takes and blocks all writers meanwhile.
+
+    Returns:
+        Dict with the database size before and after in bytes, the free
+        bytes left, the auto vacuum mode and the number of steps, or
+        None if the database is not SQLite.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return None
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+
+        def pragma(name):
+            return cursor.execute('PRAGMA ' + name).fetchone()[0]
+
+        page_size = pragma('page_size')
+        size_before = pragma('page_count') * page_size
+        steps = 0
+        if full:
+            cursor.execute('VACUUM')
+            steps = 1
+        elif pragma('auto_vacuum') == AUTO_VACUUM_INCREMENTAL:
+            deadline = time.time() + budget
+            while pragma('freelist_count') and time.time() < deadline:
+                check_lease()
+                # execute() only runs the pragma's first step, which frees one page, executescript() runs all
+                cursor.executescript('PRAGMA incremental_vacuum(%d);' % step_pages)
+                steps += 1
+        return {
+            'size_before': size_before,
+            'size_after': pragma('page_count') * page_size,
+            'free_after': pragma('freelist_count') * page_size,
+            'auto_vacuum': 'incremental' if pragma('auto_vacuum') == AUTO_VACUUM_INCREMENTAL else 'none',
+            'steps': steps,
+        }
+    finally:
+        connection.close()
+
+
+def run_maintenance(budget=10, full_vacuum=False):
+    """Purge orphans, refresh statistics and vacuum.
+
+    Args:
+        budget: Max seconds of incremental vacuum.
+        full_vacuum: Run a full VACUUM instead of an incremental one.
+
+    Returns:
+        Dict with the result and the seconds taken by every step, the
+        reclaimed bytes and the total seconds.
+    """
+    started = time.time()
+    report = {}
+
+    step_started = time.time()
+    report['purged'] = purge_orphans()
+    report['purge_seconds'] = round(time.time() - step_started, 3)
+
+    step_started = time.time()
+    report['analyzed'] = analyze()
+    report['analyze_seconds'] = round(time.time() - step_started, 3)
+
+    step_started = time.time()
+    report['vacuum'] = vacuum(budget, full=full_vacuum)
+    report['vacuum_seconds'] = round(time.time() - step_started, 3)
+
+    vacuum_report = report['vacuum']
+    report['reclaimed_bytes'] = vacuum_report['size_before'] - vacuum_report['size_after'] if vacuum_report else 0
+    report['seconds'] = round(time.time() - started, 3)
+    print('maintenance: purged %s, reclaimed %d bytes in %.1f s' % (
+        report['purged'], report['reclaimed_bytes'], report['seconds']))
+    return report
@@ -0,0 +1,137 @@
+"""Dry-run planner - Habitica To Do Over tool
+
+Estimates what the next scheduled run will do and cost, without
+writing anything. Every task goes through the same decision function
+as the real run, get_recreate_decision, using the cached Habitica
+status snapshots of the dashboard instead of one request per task.
+Only the needed columns are read, as plain rows, so planning in a web
+request doesn't load or detach any objects of the request's session.
+"""
+from __future__ import absolute_import
+
+from datetime import datetime
+
+import requests
+from sqlalchemy import tuple_
+
+from extensions import db, task_status_cache
+from models import RetryItem, Task, TaskInstance, User
+from .recurrence import RULE_COMPLETION
+from .retry_queue import get_pending_task_ids
+from .scheduled_script import RECREATE, get_recreate_decision, get_utc_today
+from .to_do_overs_data import ToDoOversData
+
+# Habitica requests of a due retry queue item, at most: a check reads the task and may recreate it
+RETRY_CALLS = {'check': 2}
+
+
+def _get_statuses(owner, refresh):
+    if not refresh:
+        return task_status_cache.get(owner)
+    # A cached snapshot may be older than the task's completion
+    tdo_data = ToDoOversData()
+    try:
+        statuses = tdo_data.get_user_task_status(owner, User.query.get(owner).api_token)
+    except requests.RequestException:
+        statuses = False
+    if statuses is False:
+        return None
+    task_status_cache.set(owner, statuses)
+    return statuses
+
+
+def _iter_task_rows(chunk_size):
+    # Like iter_tasks in (owner, id) order, with the columns the decision needs
+    query = db.session.query(Task.id, Task.owner, Task.rule, Task.next_fire, Task.delay,
+                             TaskInstance.habitica_id).outerjoin(TaskInstance, TaskInstance.task_id == Task.id)
+    last_key = None
+    while True:
+        chunk_query = query
+        if last_key is not None:
+            chunk_query = chunk_query.filter(tuple_(Task.owner, Task.id) > tuple_(*last_key))
+        chunk = chunk_query.order_by(Task.owner, Task.id).limit(chunk_size).all()
+        if not chunk:
+            return
+        last_key = (chunk[-1].owner, chunk[-1].id)
+        for row in chunk:
+            yield row
+
+
+def _finish_owner(plan, owner, rate, period, request_time):
+    calls = owner['calls']
+    # 每个用户的请求按顺序发出，并受 Habitica 每个用户的速率限制
+    owner['seconds'] = round(max(calls * request_time, max(0, calls - rate) * period / float(rate)), 1)
+    plan['owners'].append(owner)
+    plan['total_calls'] += calls
+    plan['projected_seconds'] += owner['seconds']
+    plan['recreate_count'] += len(owner['recreate'])
+    plan['unknown_count'] += owner['unknown']
+
+
+def plan_run(now=None, refresh=False, rate=30, period=60, request_time=0.5, chunk_size=500):
+    """Plan the next scheduled run without writing to the database or Habitica.
+
+    Args:
+        now: Naive UTC datetime of the run, defaults to now.
+        refresh: Fetch fresh status snapshots of every owner with the
+            read-only batched list calls (two per owner, not counted in
+            the plan) instead of using the cached ones.
+        rate: Number of Habitica requests allowed per period per user.
+        period: Length of the rate limit period in seconds.
+        request_time: Expected seconds per Habitica request.
+        chunk_size: Number of tasks read per query.
+
+    Returns:
+        Dict with the calls, the projected time and the tasks that would
+        be recreated for each owner, and the totals. Tasks without a
+        known Habitica status are counted as unknown. Due retry queue
+        items run first and are counted as one call each, a check as
+        two.
+    """
+    now = now or datetime.utcnow()
+    utc_today = get_utc_today()
+    plan = {'generated_at': now.isoformat() + 'Z', 'owners': [], 'total_calls': 0, 'projected_seconds': 0,
+            'recreate_count': 0, 'unknown_count': 0, 'retry_count': 0}
+    for (kind,) in db.session.query(RetryItem.kind).filter(RetryItem.next_attempt_at <= now):
+        plan['retry_count'] += 1
+        plan['total_calls'] += RETRY_CALLS.get(kind, 1)
+    pending_task_ids = get_pending_task_ids()
+    owner = None
+    statuses = None
+    tags_counted = False
+
+    for task in _iter_task_rows(chunk_size):
+        if owner is None or task.owner != owner['owner']:
+            if owner is not None:
+                _finish_owner(plan, owner, rate, period, request_time)
+            owner = {'owner': task.owner, 'tasks': 0, 'calls': 0, 'recreate': [], 'unknown': 0}
+            statuses = _get_statuses(task.owner, refresh)
+            tags_counted = False
+
+        if task.id in pending_task_ids:
+            # Left to the retry queue
+            continue
+        is_rule = task.rule and task.rule != RULE_COMPLETION
+        if is_rule and (task.next_fire is None or task.next_fire > now):
+            # Rule tasks that are not due are not read by the run
+            continue
+        if not is_rule and not tags_counted:
+            # The run fetches the owner's tags before the owner's first task
+            owner['calls'] += 1
+            tags_counted = True
+        owner['tasks'] += 1
+        # One request to read the task
+        owner['calls'] += 1
+
+        status = statuses.get(task.habitica_id) if statuses else None
+        if status is None:
+            owner['unknown'] += 1
+        elif get_recreate_decision(task, status, utc_today) == RECREATE:
+            # One more request to create the new instance
+            owner['calls'] += 1
+            owner['recreate'].append(task.id)
+
+    if owner is not None:
+        _finish_owner(plan, owner, rate, period, request_time)
+    plan['projected_seconds'] = round(plan['projected_seconds'], 1)
+    return plan
@@ -0,0 +1,132 @@
+"""Profiling hooks - Habitica To Do Over tool
+
+A sampling profiler for single requests and scheduler runs. Samples of
+one thread's stack are counted and saved in the collapsed stack format
+("a;b;c 12" per line), which flamegraph.pl and speedscope read directly.
+Nothing is registered or sampled unless profiling is asked for.
+"""
+from __future__ import absolute_import
+
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from flask import g, request
+from flask_login import current_user
+
+
+class Sampler(object):
+    """Samples the stack of one thread at a fixed interval.
+
+    Attributes:
+        thread_id (int): ID of the sampled thread.
+        interval (float): Seconds between samples.
+        stacks (Counter): Number of samples per collapsed stack.
+    """
+
+    def __init__(self, thread_id=None, interval=0.005):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def collapsed(self):
+        """Get the samples in the collapsed stack format."""
+        return ''.join('%s %d\n' % (stack, count) for stack, count in self.stacks.most_common())
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+
+def save_profile(profile_dir, name, sampler):
+    """Save a sampler's stacks to profile_dir/<name>.folded.
+
+    Returns:
+        The profile ID, which is the file name without extension.
+    """
+    if not os.path.exists(profile_dir):
+        os.makedirs(profile_dir)
+    with open(os.path.join(profile_dir, name + '.folded'), 'w') as profile_file:
+        profile_file.write(sampler.collapsed())
+    return name
+
+
+def list_profiles(profile_dir):
+    """Get the saved profile IDs, newest first."""
+    if not os.path.exists(profile_dir):
+        return []
+    files = [filename for filename in os.listdir(profile_dir) if filename.endswith('.folded')]
+    files.sort(key=lambda filename: os.path.getmtime(os.path.join(profile_dir, filename)), reverse=True)
+    return [filename[:-len('.folded')] for filename in files]
+
+
+def init_profiling(app):
+    """Profile requests of admins that ask for it.
+
+    A request is profiled when it has a 'profile' query argument or an
+    X-Profile header and comes from an admin. The profile ID is returned
+    in the X-Profile-Id response header.
+
+    Args:
+        app: The Flask app.
+    """
+    if not app.config['PROFILING_ENABLED']:
+        return
+
+    profile_dir = app.config['PROFILE_DIR']
+    interval = app.config['PROFILE_INTERVAL']
+
+    @app.before_request
+    def start_profiling():
+        if 'profile' not in request.args and 'X-Profile' not in request.headers:
+            return
+        if not current_user.is_authenticated or current_user.role != 'admin':
+            return
+        g.profiler = Sampler(interval=interval)
+        g.profiler.start()
+        g.profile_started_at = time.time()
+
+    @app.after_request
+    def stop_profiling(response):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+        profiler.stop()
+        name = 'request-%s-%s' % (time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8])
+        response.headers['X-Profile-Id'] = save_profile(profile_dir, name, profiler)
+        response.headers['X-Profile-Time'] = '%.3f' % (time.time() - g.pop('profile_started_at'))
+        return response
+
+    @app.teardown_request
+    def discard_profiling(exception):
+        # after_request 不会在未处理的异常之后运行，这里确保采样线程停止
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.stop()
@@ -0,0 +1,61 @@
+"""Habitica rate limiting - Habitica To Do Over tool
+
+Habitica allows each user a fixed number of API requests per minute.
+Requests made for the same user share one token bucket, so concurrent
+workers stay under the limit together.
+"""
+from __future__ import absolute_import
+
+import threading
+import time
+
+
+class RateLimiter(object):
+    """A thread-safe token bucket.
+
+    Attributes:
+        rate (int): Number of requests allowed per period.
+        period (float): Length of the period in seconds.
+    """
+
+    def __init__(self, rate, period):
+        self.rate = rate
+        self.period = period
+        self._tokens = float(rate)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, sleeping until one is available."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated_at) * self.rate / self.period)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) * self.period / self.rate
+            time.sleep(wait)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(user_id, rate=30, period=60):
+    """Get the shared rate limiter of a Habitica user.
+
+    Args:
+        user_id: Habitica user ID.
+        rate: Number of requests allowed per period.
+        period: Length of the period in seconds.
+
+    Returns:
+        The user's RateLimiter.
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(user_id)
+        if limiter is None:
+            limiter = _limiters[user_id] = RateLimiter(rate, period)
+        return limiter
@@ -0,0 +1,68 @@
+"""Recurrence rules - Habitica To Do Over tool
+
+Besides being recreated after completion, a task can be recreated on a
+calendar rule. Every rule task stores its next fire time in the indexed
+Task.next_fire column, so the scheduler only reads the tasks that are due.
+Fire times are midnight UTC, like the rest of the scheduler.
+"""
+from __future__ import absolute_import
+
+import calendar
+from datetime import datetime, timedelta
+
+RULE_COMPLETION = 'completion'
+RULE_WEEKLY = 'weekly'
+RULE_MONTHLY = 'monthly'
+RULE_INTERVAL = 'interval'
+
+
+def parse_weekdays(weekdays):
+    """Parse the stored weekdays, e.g. '0,2,4', Monday being 0."""
+    return sorted(int(day) for day in (weekdays or '').split(',') if day != '')
+
+
+def get_next_fire(task, after):
+    """Get the first fire time of a task's rule strictly after a time.
+
+    Args:
+        task: The task, with rule and rule_* fields set.
+        after: Naive UTC datetime.
+
+    Returns:
+        Naive UTC datetime at midnight, or None for completion based
+        tasks and incomplete rules.
+    """
+    day = datetime(after.year, after.month, after.day) + timedelta(days=1)
+
+    if task.rule == RULE_WEEKLY:
+        weekdays = parse_weekdays(task.rule_weekdays)
+        if not weekdays:
+            return None
+        for offset in range(7):
+            candidate = day + timedelta(days=offset)
+            if candidate.weekday() in weekdays:
+                return candidate
+
+    elif task.rule == RULE_MONTHLY:
+        if not task.rule_monthday:
+            return None
+        year, month = day.year, day.month
+        while True:
+            # 没有这一天的月份在当月最后一天创建
+            monthday = min(task.rule_monthday, calendar.monthrange(year, month)[1])
+            candidate = datetime(year, month, monthday)
+            if candidate >= day:
+                return candidate
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    elif task.rule == RULE_INTERVAL:
+        if not task.rule_interval or task.rule_interval < 1:
+            return None
+        anchor = task.rule_anchor or day
+        anchor = datetime(anchor.year, anchor.month, anchor.day)
+        if anchor >= day:
+            return anchor
+        periods = -(-(day - anchor).days // task.rule_interval)
+        return anchor + timedelta(days=periods * task.rule_interval)
+
+    return None
@@ -0,0 +1,166 @@
+"""Retry queue - Habitica To Do Over tool
+
+Habitica operations that failed are stored in the retry_item table
+instead of being retried in a sleep loop. The scheduler drains the due
+items before doing new work; each failure pushes the next attempt back
+with exponential backoff and jitter. Items that fail too often move to
+the dead_letter table, where admins can inspect and replay them.
+"""
+from __future__ import absolute_import
+
+import json
+import random
+import traceback
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from extensions import db
+from models import DeadLetter, RetryItem
+from .jobs import LeaseLost, check_lease
+
+
+class RetryableError(Exception):
+    """Raised by a handler when the item should be tried again later."""
+
+
+def get_backoff(attempts, base_delay=300, max_delay=21600):
+    """Get the seconds to wait before the next attempt.
+
+    The delay doubles with every attempt up to max_delay. Half of it is
+    random, so items that failed together, e.g. on a 429, don't all come
+    back at the same moment.
+    """
+    delay = min(max_delay, base_delay * 2 ** attempts)
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+def is_retryable(return_code):
+    """Whether a failed Habitica request may succeed later.
+
+    Rate limiting, server errors and requests that got no response
+    (return code 0) are retried, other client errors are not.
+    """
+    return return_code == 0 or return_code == 429 or return_code >= 500
+
+
+def _get_backoff(attempts):
+    config = current_app.config
+    return get_backoff(attempts, config.get('RETRY_BASE_DELAY', 300), config.get('RETRY_MAX_DELAY', 21600))
+
+
+def enqueue(owner, kind, task_id=None, payload=None, error=None, now=None):
+    """Add a failed operation to the retry queue.
+
+    An operation already queued for the same task is not added twice.
+    Nothing is committed.
+
+    Args:
+        owner: ID of the user.
+        kind: One of RetryItem.KINDS.
+        task_id: ID of the task template, None for a task that is not
+            created yet.
+        payload: JSON serializable data the handler needs.
+        error: Why it failed.
+        now: Naive UTC datetime.
+
+    Returns:
+        The RetryItem.
+    """
+    if task_id is not None:
+        item = RetryItem.query.filter(RetryItem.kind == kind, RetryItem.task_id == task_id).first()
+        if item is not None:
+            return item
+    now = now or datetime.utcnow()
+    item = RetryItem(owner=owner, kind=kind, task_id=task_id, attempts=0, last_error=error, created_at=now,
+                     payload=json.dumps(payload) if payload is not None else None,
+                     next_attempt_at=now + timedelta(seconds=_get_backoff(0)))
+    db.session.add(item)
+    print('queued %s of task %s for retry' % (kind, task_id))
+    return item
+
+
+def get_pending_task_ids():
+    """Get the IDs of the task templates with a queued operation."""
+    return {task_id for (task_id,) in db.session.query(RetryItem.task_id).filter(RetryItem.task_id.isnot(None))}
+
+
+def drain(handlers, now=None, limit=None):
+    """Run the due items of the queue, oldest due first.
+
+    A handler gets the item and its decoded payload. It returns when the
+    item is done and raises RetryableError (or any other exception) to
+    try again later. Every item is committed on its own.
+
+    Args:
+        handlers: Dict of kind to handler function.
+        now: Naive UTC datetime.
+        limit: Max number of items to run.
+
+    Returns:
+        Dict with the number of items done, retried and dead lettered.
+    """
+    now = now or datetime.utcnow()
+    max_attempts = current_app.config.get('RETRY_MAX_ATTEMPTS', 5)
+    result = {'done': 0, 'retried': 0, 'dead': 0}
+    query = db.session.query(RetryItem.id).filter(RetryItem.next_attempt_at <= now).order_by(
+        RetryItem.next_attempt_at)
+    if limit:
+        query = query.limit(limit)
+
+    for (item_id,) in query.all():
+        check_lease()
+        item = RetryItem.query.get(item_id)
+        if item is None:
+            # Deleted with its task by an earlier item
+            continue
+        payload = json.loads(item.payload) if item.payload else None
+        try:
+            handlers[item.kind](item, payload)
+        except RetryableError as error:
+            db.session.rollback()
+            item = RetryItem.query.get(item_id)
+            _fail(item, str(error), now, max_attempts, result)
+        except LeaseLost:
+            # Not the item's fault, it stays due for the next run
+            db.session.rollback()
+            raise
+        except Exception:
+            db.session.rollback()
+            item = RetryItem.query.get(item_id)
+            _fail(item, traceback.format_exc(), now, max_attempts, result)
+        else:
+            # Deleting the task, e.g. after a 404, already deleted its items
+            if item in db.session:
+                db.session.delete(item)
+            result['done'] += 1
+        db.session.commit()
+    return result
+
+
+def _fail(item, error, now, max_attempts, result):
+    item.attempts += 1
+    item.last_error = error
+    if item.attempts >= max_attempts:
+        db.session.add(DeadLetter(owner=item.owner, kind=item.kind, task_id=item.task_id, payload=item.payload,
+                                  attempts=item.attempts, last_error=error, created_at=item.created_at,
+                                  failed_at=now))
+        db.session.delete(item)
+        result['dead'] += 1
+        print('%s of task %s moved to dead letters' % (item.kind, item.task_id))
+    else:
+        item.next_attempt_at = now + timedelta(seconds=_get_backoff(item.attempts))
+        result['retried'] += 1
+
+
+def replay(dead_letter, now=None):
+    """Move a dead letter back to the queue.
+
+    The item is due right away and its attempts start from zero again.
+    Nothing is committed.
+    """
+    now = now or datetime.utcnow()
+    db.session.add(RetryItem(owner=dead_letter.owner, kind=dead_letter.kind, task_id=dead_letter.task_id,
+                             payload=dead_letter.payload, attempts=0, last_error=dead_letter.last_error,
+                             created_at=dead_letter.created_at, next_attempt_at=now))
+    db.session.delete(dead_letter)
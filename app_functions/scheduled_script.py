@@ -9,244 +9,446 @@ from builtins import str
 __author__ = "Katie Patterson kirska.com"
 __license__ = "MIT"
 
-from datetime import datetime
-import time
+import json
+from datetime import datetime, timedelta
 import pytz
 import requests
 
-from models import Task, User
+from flask import current_app
+from sqlalchemy import or_, tuple_
+from sqlalchemy.orm import selectinload
+
+from models import Task, Tag, User
 from app_functions.cipher_functions import decrypt_text
-from app_functions.to_do_overs_data import ToDoOversData
+from app_functions.jobs import check_lease
+from app_functions.recurrence import RULE_COMPLETION, get_next_fire
+from app_functions.retry_queue import RetryableError, drain, enqueue, get_pending_task_ids
+from app_functions.statistics import record_miss, record_recreation
+from app_functions.to_do_overs_data import TASK_FIELDS, ToDoOversData, habitica_session, read_response_data
 from extensions import db
 
+# Decisions of get_recreate_decision
+RECREATE = 'recreate'
+WAITING = 'waiting'
+OPEN = 'open'
 
-def check_recreate_task(tdo_data, req, task):
-    req_json = req.json()
-    if req_json['data']['completed'] and task.delay == 0:
-        # Task was completed and there is no delay so recreate it
-        tdo_data.hab_user_id = task.owner
-        tdo_data.priority = task.priority
-        tdo_data.api_token = User.query.get(tdo_data.hab_user_id).api_token
-        tdo_data.notes = task.notes
-        tdo_data.task_name = task.name
-        tdo_data.task_days = task.days
+# Format of datetimes in retry queue payloads
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
 
-        # convert tags from their DB ID to the tag UUID
-        tag_list = []
-        for tag in task.tags:
-            tag_list.append(tag.id)
 
-        tdo_data.tags = tag_list
+def get_completed_date(date_completed):
+    """Parse Habitica's dateCompleted and round it down to the UTC day.
 
-        retry = True
-        delay_seconds = 0
+    Args:
+        date_completed: dateCompleted string of a Habitica task.
 
-        while retry:
-            try:
-                if tdo_data.create_task(tdo_data.hab_user_id, tdo_data.api_token, tdo_data.task_name, tdo_data.notes,
-                                        tdo_data.task_days, tdo_data.priority, tdo_data.tags):
-                    new_task = Task()
-                    new_task.id = tdo_data.task_id
-                    new_task.owner = task.owner
-                    new_task.notes = task.notes
-                    new_task.tags = task.tags
-                    new_task.name = task.name
-                    new_task.days = task.days
-                    new_task.priority = task.priority
-                    new_task.delay = task.delay
-                    db.session.delete(task)
-                    db.session.add(new_task)
-                    db.session.commit()
-                    retry = False
-                    delay_seconds = 0
-                    print('task re-created successfully ' + task.id)
-                else:
-                    print('task creation failed ' + task.id)
-                    if tdo_data.return_code == 429:
-                        print('too many requests, sleeping')
-                        retry = True
-                        delay_seconds += 90
-                        if delay_seconds > 500:
-                            # stop trying
-                            retry = False
-                            delay_seconds = 0
-                        else:
-                            time.sleep(delay_seconds)
-                    else:
-                        print('unknown failure')
-                        retry = False
-                        delay_seconds = 0
-            except AttributeError:
-                print('attribute error, sleep and retry')
-                retry = True
-                delay_seconds += 90
-                if delay_seconds > 500:
-                    # stop trying
-                    retry = False
-                    delay_seconds = 0
-                else:
-                    time.sleep(delay_seconds)
-
-    elif req_json['data']['completed']:
-        # Task was completed but has a delay
-        # Get completed date and set to UTC timezone
-        completed_date_naive = datetime.strptime(
-            req_json['data']['dateCompleted'], '%Y-%m-%dT%H:%M:%S.%fZ'
-        )
-        utc_timezone = pytz.timezone("UTC")
-        completed_date_aware = utc_timezone.localize(
-            completed_date_naive
-        )
-        # Get current UTC time
-        utc_now = pytz.utc.localize(datetime.utcnow())
+    Returns:
+        Aware UTC datetime at midnight of the completion day.
+    """
+    completed_date_naive = datetime.strptime(
+        date_completed, '%Y-%m-%dT%H:%M:%S.%fZ'
+    )
+    utc_timezone = pytz.timezone("UTC")
+    completed_date_aware = utc_timezone.localize(
+        completed_date_naive
+    )
+    # Need to round the datetimes down to get rid of partial days
+    return completed_date_aware.replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
 
-        # Need to round the datetimes down to get rid of partial days
-        completed_date_aware = completed_date_aware.replace(
-            hour=0, minute=0, second=0, microsecond=0
-        )
-        utc_now = utc_now.replace(
-            hour=0, minute=0, second=0, microsecond=0
-        )
 
-        # TESTING - add days to current date
-        # utc_now = utc_now + timedelta(days=2)
-
-        elapsed_time = utc_now - completed_date_aware
-
-        # The delay we want is 1 + delay value
-        if elapsed_time.days > task.delay:
-            # Task was completed and the delay has passed
-            tdo_data.hab_user_id = task.owner.id
-            tdo_data.priority = task.priority
-            tdo_data.api_token = task.owner.api_token
-            tdo_data.notes = task.notes
-            tdo_data.task_name = task.name
-            tdo_data.task_days = task.days
-
-            # convert tags from their DB ID to the tag UUID
-            tag_list = []
-            for tag in task.tags.all():
-                tag_list.append(tag.tag_id)
-
-            tdo_data.tags = tag_list
-
-            retry = True
-            delay_seconds = 0
-
-            while retry:
-                if tdo_data.create_task(tdo_data.hab_user_id, tdo_data.api_token, tdo_data.task_name, tdo_data.notes,
-                                        tdo_data.task_days, tdo_data.priority, tdo_data.tags):
-                    new_task = Task()
-                    new_task.id = tdo_data.task_id
-                    new_task.owner = task.owner
-                    new_task.notes = task.notes
-                    new_task.tags = task.tags
-                    new_task.name = task.name
-                    new_task.days = task.days
-                    new_task.priority = task.priority
-                    new_task.delay = task.delay
-
-                    db.session.delete(task)
-                    db.session.add(new_task)
-                    db.session.commit()
-                    retry = False
-                    delay_seconds = 0
-                    print('task re-created successfully ' + task.id)
-                else:
-                    print('task creation failed ' + task.id)
-                    if tdo_data.return_code == 429:
-                        print('too many requests, sleeping')
-                        retry = True
-                        delay_seconds += 90
-                        if delay_seconds > 500:
-                            # stop trying
-                            retry = False
-                            delay_seconds = 0
-                        else:
-                            time.sleep(delay_seconds)
-                    else:
-                        print('unknown failure')
-                        retry = False
-                        delay_seconds = 0
-        else:
-            print('task completed but delay not met ' + task.id)
+def get_recreate_date(date_completed, delay):
+    """Get the first UTC day on which a completed task is recreated.
+
+    Args:
+        date_completed: dateCompleted string of a Habitica task.
+        delay: Delay days of the task.
+
+    Returns:
+        Aware UTC datetime at midnight of the recreation day.
+    """
+    # The delay we want is 1 + delay value
+    return get_completed_date(date_completed) + timedelta(days=delay + 1)
+
+
+def get_utc_today():
+    """Get midnight of the current UTC day."""
+    utc_now = pytz.utc.localize(datetime.utcnow())
+    return utc_now.replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+
+
+def recreate_task(tdo_data, task, task_json=None, queue_failure=True):
+    """Create a new instance of a task on Habitica.
+
+    The task template and its tags stay as they are, only the row of its
+    current instance is updated. The checklist is sent inline, so this is
+    one request however many items it has. A single attempt is made. A failed recreation is put in the retry
+    queue, unless the retry queue itself is calling.
+
+    Args:
+        tdo_data: ToDoOversData used for the Habitica request.
+        task: The task to recreate.
+        task_json: The completed instance's data from Habitica. If given,
+            the completion and the recreation are recorded for the
+            statistics in the same commit.
+        queue_failure: Put the recreation in the retry queue if it fails.
+
+    Returns:
+        The task for success, None for failure.
+    """
+    tdo_data.hab_user_id = task.owner
+    tdo_data.priority = task.priority
+    tdo_data.api_token = User.query.get(tdo_data.hab_user_id).api_token
+    tdo_data.notes = task.notes
+    tdo_data.task_name = task.name
+    tdo_data.task_days = task.days
 
+    # convert tags from their DB ID to the tag UUID
+    tag_list = []
+    for tag in task.tags:
+        tag_list.append(tag.id)
+
+    tdo_data.tags = tag_list
+
+    old_habitica_id = task.habitica_id
+    # Another run may have taken over, don't create the task twice
+    check_lease()
+    try:
+        created = tdo_data.create_task(tdo_data.hab_user_id, tdo_data.api_token, tdo_data.task_name, tdo_data.notes,
+                                       tdo_data.task_days, tdo_data.priority, tdo_data.tags, task.get_checklist())
+        error = 'create returned ' + str(tdo_data.return_code)
+    except (AttributeError, TypeError, ValueError, requests.RequestException) as exception:
+        # Bad data of one task, e.g. days that are not a number, only fails that task
+        created = False
+        error = repr(exception)
+
+    if not created:
+        print('task creation failed ' + str(old_habitica_id) + ', ' + error)
+        if queue_failure:
+            enqueue(task.owner, 'recreate', task.id, task_json, error)
+            db.session.commit()
+        return None
+
+    if task_json is not None:
+        record_recreation(task, task_json)
+    task.set_habitica_id(tdo_data.task_id, checklist=tdo_data.checklist)
+    db.session.commit()
+    print('task re-created successfully ' + str(old_habitica_id))
+    return task
+
+
+def get_recreate_decision(task, task_json, utc_today=None):
+    """Decide what the scheduler does with a task, from its Habitica state.
+
+    The real run and the dry-run planner both use this, so they can't
+    disagree.
+
+    Args:
+        task: The task.
+        task_json: The task's data from Habitica, at least 'completed'
+            and 'dateCompleted'.
+        utc_today: Midnight of the current UTC day.
+
+    Returns:
+        RECREATE, WAITING (completed but the delay was not met, or a rule
+        task that is not due) or OPEN (not completed).
+    """
+    if task.rule and task.rule != RULE_COMPLETION:
+        # Rule tasks are recreated when due, unless the current instance is still open
+        return RECREATE if task_json['completed'] else OPEN
+    if not task_json['completed']:
+        return OPEN
+    if task.delay == 0:
+        # Task was completed and there is no delay so recreate it
+        return RECREATE
+
+    # Task was completed but has a delay
+    utc_today = utc_today or get_utc_today()
+
+    # TESTING - add days to current date
+    # utc_today = utc_today + timedelta(days=2)
+
+    if utc_today >= get_recreate_date(task_json['dateCompleted'], task.delay):
+        # Task was completed and the delay has passed
+        return RECREATE
+    return WAITING
+
+
+def check_recreate_task(tdo_data, task_json, task):
+    decision = get_recreate_decision(task, task_json)
+    if decision == RECREATE:
+        return recreate_task(tdo_data, task, task_json)
+    elif decision == WAITING:
+        print('task completed but delay not met ' + str(task.id))
     else:
         print(
-            'task not completed ' + task.id
+            'task not completed ' + str(task.id)
         )
+    return None
+
+
+def _retry_check(item, payload):
+    task = Task.query.get(item.task_id)
+    if task is None:
+        return
+    tdo_data = ToDoOversData()
+    task_json = tdo_data.get_task(task.owner, User.query.get(task.owner).api_token, task.habitica_id)
+    if task_json is False:
+        if tdo_data.return_code == 404:
+            print("deleting task " + str(task.id))
+            db.session.delete(task)
+            db.session.commit()
+            return
+        raise RetryableError('get returned ' + str(tdo_data.return_code))
+    if get_recreate_decision(task, task_json) == RECREATE:
+        _retry_recreate(item, task_json)
+
+
+def _retry_recreate(item, payload):
+    task = Task.query.get(item.task_id)
+    if task is None:
+        # Deleted since
+        return
+    tdo_data = ToDoOversData()
+    if not recreate_task(tdo_data, task, payload, queue_failure=False):
+        raise RetryableError('create returned ' + str(tdo_data.return_code))
+
+
+def get_create_payload(task, tag_ids):
+    """Get the retry queue payload of a task whose creation failed.
+
+    Args:
+        task: The new task, not added to the session.
+        tag_ids: IDs of its tags.
+    """
+    values = {}
+    for column in Task.__table__.columns:
+        value = getattr(task, column.key)
+        if column.key != 'id':
+            values[column.key] = value.strftime(DATETIME_FORMAT) if isinstance(value, datetime) else value
+    return {'task': values, 'tags': list(tag_ids)}
+
+
+def _retry_create(item, payload):
+    check_lease()
+    tdo_data = ToDoOversData()
+    values = payload['task']
+    checklist = json.loads(values['checklist']) if values.get('checklist') else []
+    if not tdo_data.create_task(item.owner, User.query.get(item.owner).api_token, values['name'], values['notes'],
+                                values['days'], values['priority'], payload['tags'], checklist):
+        raise RetryableError('create returned ' + str(tdo_data.return_code))
+    task = Task()
+    for column in Task.__table__.columns:
+        if column.key in values:
+            value = values[column.key]
+            if value and isinstance(column.type, db.DateTime):
+                value = datetime.strptime(value, DATETIME_FORMAT)
+            setattr(task, column.key, value)
+    task.tags = [tag for tag in (Tag.query.get(tag_id) for tag_id in payload['tags']) if tag]
+    task.set_habitica_id(tdo_data.task_id, checklist=tdo_data.checklist)
+    db.session.add(task)
+    db.session.commit()
+
+
+def _retry_edit(item, payload):
+    task = Task.query.get(item.task_id)
+    if task is None:
+        return
+    # The local row already has the edit, send its current state
+    check_lease()
+    tdo_data = ToDoOversData()
+    api_token = User.query.get(task.owner).api_token
+    if not tdo_data.edit_task(task.owner, api_token, task.habitica_id, task.name, task.notes,
+                              task.days, task.priority, [tag.id for tag in task.tags]):
+        raise RetryableError('edit returned ' + str(tdo_data.return_code))
+    try:
+        edited = tdo_data.edit_checklist(task.owner, api_token, task.habitica_id, task.instance.get_checklist(),
+                                         task.get_checklist())
+        error = 'checklist returned ' + str(tdo_data.return_code)
+    except requests.RequestException as exception:
+        edited = False
+        error = repr(exception)
+    # Keep the items that were sent, the next attempt only sends the rest
+    task.instance.set_checklist(tdo_data.checklist)
+    db.session.commit()
+    if not edited:
+        raise RetryableError(error)
+
+
+RETRY_HANDLERS = {
+    'check': _retry_check,
+    'recreate': _retry_recreate,
+    'create': _retry_create,
+    'edit': _retry_edit,
+}
+
+
+def drain_retries(now=None):
+    """Run the due items of the retry queue."""
+    result = drain(RETRY_HANDLERS, now)
+    print('retry queue: %(done)d done, %(retried)d retried later, %(dead)d dead lettered' % result)
+    return result
+
+
+def run_due_rules(now=None):
+    """Recreate the rule based tasks whose fire time has passed.
+
+    Only the due tasks are read, with a range scan on the Task.next_fire
+    index, so the cost of a run doesn't grow with the number of rules.
+    A task whose current instance is still open is not recreated, its
+    fire time just moves on. So does the fire time of a task whose
+    recreation failed, the retry queue takes it over.
+
+    Args:
+        now: Naive UTC datetime, defaults to the current time.
+    """
+    now = now or datetime.utcnow()
+    due_task_ids = [task_id for (task_id,) in db.session.query(Task.id).filter(
+        Task.next_fire <= now).order_by(Task.next_fire)]
+    pending_task_ids = get_pending_task_ids()
+
+    for task_id in due_task_ids:
+        check_lease()
+        if task_id in pending_task_ids:
+            continue
+        task = Task.query.get(task_id)
+        tdo_data = ToDoOversData()
+        api_token = User.query.get(task.owner).api_token
+        next_fire = get_next_fire(task, now)
+
+        try:
+            task_json = tdo_data.get_task(task.owner, api_token, task.habitica_id)
+        except requests.RequestException as exception:
+            enqueue(task.owner, 'check', task.id, error=repr(exception))
+            task.next_fire = next_fire
+            db.session.commit()
+            continue
+        if task_json and get_recreate_decision(task, task_json) == OPEN:
+            print('task still open, skip this time ' + str(task.id))
+            record_miss(task, now)
+            task.next_fire = next_fire
+            db.session.commit()
+        elif task_json:
+            task.next_fire = next_fire
+            recreate_task(tdo_data, task, task_json)
+        elif tdo_data.return_code == 404:
+            print("deleting task " + str(task.id))
+            db.session.delete(task)
+            db.session.commit()
+        else:
+            print('weird return code ' + str(tdo_data.return_code))
+            enqueue(task.owner, 'check', task.id, error='get returned ' + str(tdo_data.return_code))
+            task.next_fire = next_fire
+            db.session.commit()
+
+
+def iter_tasks(query, chunk_size=500):
+    """Iterate over tasks in (owner, id) order with keyset pagination.
+
+    Only one chunk of tasks is loaded at a time, with the tags of the
+    whole chunk in one more query, and it is expunged from the session
+    before the next chunk is read, so memory stays flat however many
+    tasks there are. Commits made while iterating don't expire the
+    chunk, so its tasks are not read again one by one. This expunges
+    every object of the session, don't use it in a web request.
+
+    Args:
+        query: Task query to iterate over.
+        chunk_size: Number of tasks loaded per query.
+
+    Yields:
+        Tasks ordered by owner, then ID.
+    """
+    session = db.session()
+    expire_on_commit = session.expire_on_commit
+    session.expire_on_commit = False
+    try:
+        last_key = None
+        while True:
+            chunk_query = query.options(selectinload(Task.tags))
+            if last_key is not None:
+                chunk_query = chunk_query.filter(tuple_(Task.owner, Task.id) > tuple_(*last_key))
+            chunk = chunk_query.order_by(Task.owner, Task.id).limit(chunk_size).all()
+            if not chunk:
+                return
+            last_key = (chunk[-1].owner, chunk[-1].id)
+            for task in chunk:
+                # Between tasks, stop if the run's lease was lost
+                check_lease()
+                yield task
+            db.session.expunge_all()
+    finally:
+        session.expire_on_commit = expire_on_commit
 
 
 def run():
-    TASKS = Task.query.all()
-    user_tags_fetched = []
+    # Earlier failures go first, before new work uses up the rate limits
+    drain_retries()
+    run_due_rules()
+
+    query = Task.query.filter(or_(Task.rule == RULE_COMPLETION, Task.rule.is_(None)))
+    # Tasks with a queued operation are left to the retry queue
+    pending_task_ids = get_pending_task_ids()
+    # Tasks come ordered by owner, so only the current owner is remembered
+    current_owner = None
+    owner_row = None
+    api_token = None
+
+    for task_ in iter_tasks(query, current_app.config.get('SCHEDULED_CHUNK_SIZE', 500)):
+        if task_.id in pending_task_ids:
+            continue
 
-    for task_ in TASKS:
         tdo_data = ToDoOversData()
 
-        too_many_requests_delay = True
-        current_delay = 0
+        # Holding the owner's row keeps it in the session, recreate_task gets it without a query.
+        # A new chunk expunged it
+        if task_.owner != current_owner or owner_row not in db.session:
+            owner_row = User.query.get(task_.owner)
+            api_token = owner_row.api_token
 
         # update user's tags
-        if task_.owner not in user_tags_fetched:
-            user_tags_fetched.append(task_.owner)
-            while too_many_requests_delay:
-                tdo_data.hab_user_id = task_.owner
-                tdo_data.api_token = User.query.get(task_.owner).api_token
+        if task_.owner != current_owner:
+            current_owner = task_.owner
+            tdo_data.hab_user_id = task_.owner
+            tdo_data.api_token = api_token
+            try:
                 if not tdo_data.get_user_tags(tdo_data.hab_user_id, tdo_data.api_token):
-                    if tdo_data.return_code == 429:
-                        # too many requests
-                        current_delay += 90
-                        too_many_requests_delay = True
-                        print("too many requests, sleeping")
-                        if current_delay > 500:
-                            # stop trying
-                            too_many_requests_delay = False
-                            current_delay = 0
-                        else:
-                            time.sleep(current_delay)
-                    else:
-                        too_many_requests_delay = False
-                        current_delay = 0
-                else:
-                    too_many_requests_delay = False
-                    current_delay = 0
-
-            too_many_requests_delay = True
-            current_delay = 0
-
-        while too_many_requests_delay:
-            url = 'https://habitica.com/api/v3/tasks/' + str(task_.id)
-            headers = {
-                'x-api-user': str(task_.owner),
-                'x-api-key': decrypt_text(
-                    tdo_data.api_token
-                )
-            }
-
-            req_ = requests.get(url, headers=headers)
-
-            if req_.status_code == 429:
-                # too many requests
-                current_delay += 90
-                too_many_requests_delay = True
-                print("too many requests, sleeping")
-                if current_delay > 500:
-                    # stop trying
-                    too_many_requests_delay = False
-                    current_delay = 0
-                else:
-                    time.sleep(current_delay)
-            elif req_.status_code == 200:
-                check_recreate_task(tdo_data, req_, task_)
-                too_many_requests_delay = False
-            elif req_.status_code == 404:
-                print("deleting task " + task_.id)
-                task = Task.query.get(task_.id)
-                db.session.delete(task)
-                db.session.commit()
-                too_many_requests_delay = False
-            else:
-                print("weird return code")
-                print(req_.status_code)
-                too_many_requests_delay = False
+                    print('could not update the tags of ' + task_.owner + ', ' + str(tdo_data.return_code))
+            except requests.RequestException as exception:
+                print('could not update the tags of ' + task_.owner + ', ' + repr(exception))
+
+        tdo_data.hab_user_id = task_.owner
+        tdo_data.api_token = api_token
+
+        url = 'https://habitica.com/api/v3/tasks/' + str(task_.habitica_id)
+        headers = {
+            'x-api-user': str(task_.owner),
+            'x-api-key': decrypt_text(
+                tdo_data.api_token
+            )
+        }
+
+        try:
+            with habitica_session.get(url, headers=headers, stream=True) as req_:
+                # Only keep the fields the decision and the statistics need
+                task_json = read_response_data(req_, TASK_FIELDS) if req_.status_code == 200 else None
+        except requests.RequestException as exception:
+            enqueue(task_.owner, 'check', task_.id, error=repr(exception))
+            db.session.commit()
+            continue
+
+        if req_.status_code == 200:
+            check_recreate_task(tdo_data, task_json, task_)
+        elif req_.status_code == 404:
+            print("deleting task " + str(task_.id))
+            db.session.delete(task_)
+            db.session.commit()
+        else:
+            # 429 and server errors are checked again by the retry queue
+            print("weird return code")
+            print(req_.status_code)
+            enqueue(task_.owner, 'check', task_.id, error='get returned ' + str(req_.status_code))
+            db.session.commit()
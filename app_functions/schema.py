@@ -0,0 +1,118 @@
+"""Schema upgrade - Habitica To Do Over tool
+
+db.create_all only creates missing tables. This adds the columns and
+indexes that were added to existing tables since the database was
+created, and runs the migrations that need more than that.
+"""
+from __future__ import absolute_import
+
+from sqlalchemy import Integer, inspect
+from sqlalchemy.schema import CreateColumn
+
+
+def _split_task_instances(db, inspector):
+    """Move the Habitica IDs out of the task table.
+
+    Tasks used to be keyed by the ID of their current Habitica task and
+    were replaced by a new row on every recreation. They become templates
+    with a stable integer ID, which is the old rowid, and the Habitica ID
+    goes to task_instance. Tag links, statistics and queued retries are
+    moved over to the new IDs.
+    """
+    legacy_columns = {column['name'] for column in inspector.get_columns('task')}
+    tables = set(inspector.get_table_names())
+    task_table = db.metadata.tables['task']
+    columns = [column.name for column in task_table.columns if column.name != 'id' and column.name in legacy_columns]
+    series_key = 'coalesce(l.series_id, l.id)' if 'series_id' in legacy_columns else 'l.id'
+
+    with db.engine.begin() as connection:
+        # The search index and its triggers are recreated by init_search
+        for trigger in ('task_fts_insert', 'task_fts_delete', 'task_fts_update'):
+            connection.exec_driver_sql('DROP TRIGGER IF EXISTS %s' % trigger)
+        connection.exec_driver_sql('DROP TABLE IF EXISTS task_fts')
+        for table in ('task', 'task_tag'):
+            for table_index in inspector.get_indexes(table):
+                connection.exec_driver_sql('DROP INDEX IF EXISTS %s' % table_index['name'])
+        connection.exec_driver_sql('ALTER TABLE task RENAME TO task_legacy')
+        connection.exec_driver_sql('ALTER TABLE task_tag RENAME TO task_tag_legacy')
+        db.metadata.create_all(bind=connection, tables=[
+            task_table, db.metadata.tables['task_tag'], db.metadata.tables['task_instance']])
+
+        connection.exec_driver_sql('INSERT INTO task (id, %s) SELECT rowid, %s FROM task_legacy' % (
+            ', '.join(columns), ', '.join(columns)))
+        connection.exec_driver_sql('INSERT INTO task_instance (task_id, habitica_id) SELECT rowid, id FROM task_legacy')
+        connection.exec_driver_sql('INSERT INTO task_tag (task_id, tag_id) SELECT l.rowid, t.tag_id '
+                                   'FROM task_tag_legacy t JOIN task_legacy l ON l.id = t.task_id')
+
+        for table, column, key in (('task_stat', 'series_id', series_key), ('task_event', 'series_id', series_key),
+                                   ('retry_item', 'task_id', 'l.id'), ('dead_letter', 'task_id', 'l.id')):
+            if table in tables:
+                connection.exec_driver_sql(
+                    'UPDATE {table} SET {column} = (SELECT l.rowid FROM task_legacy l '
+                    'WHERE {key} = {table}.{column}) '
+                    'WHERE {column} IN (SELECT {key} FROM task_legacy l)'.format(table=table, column=column, key=key))
+        if 'retry_item' in tables:
+            # Operations on tasks deleted since are moot
+            connection.exec_driver_sql('DELETE FROM retry_item WHERE task_id IS NOT NULL '
+                                       'AND task_id NOT IN (SELECT CAST(id AS TEXT) FROM task)')
+
+        connection.exec_driver_sql('DROP TABLE task_tag_legacy')
+        connection.exec_driver_sql('DROP TABLE task_legacy')
+
+
+def _convert_task_id_columns(db, inspector):
+    """Turn the text task_id of queued operations into a foreign key.
+
+    retry_item and dead_letter stored the task ID as text without a
+    foreign key. SQLite can't change a column, so the tables are rebuilt.
+    Operations on tasks deleted since are dropped, as the ON DELETE
+    CASCADE of the new column would have done.
+    """
+    tables = set(inspector.get_table_names())
+    for table_name in ('retry_item', 'dead_letter'):
+        if table_name not in tables:
+            continue
+        task_id_column = [column for column in inspector.get_columns(table_name) if column['name'] == 'task_id']
+        if not task_id_column or isinstance(task_id_column[0]['type'], Integer):
+            continue
+        table = db.metadata.tables[table_name]
+        legacy_columns = {column['name'] for column in inspector.get_columns(table_name)}
+        columns = [column.name for column in table.columns if column.name in legacy_columns]
+        with db.engine.begin() as connection:
+            for table_index in inspector.get_indexes(table_name):
+                connection.exec_driver_sql('DROP INDEX IF EXISTS %s' % table_index['name'])
+            connection.exec_driver_sql('ALTER TABLE {0} RENAME TO {0}_legacy'.format(table_name))
+            db.metadata.create_all(bind=connection, tables=[table])
+            connection.exec_driver_sql(
+                'INSERT INTO {table} ({columns}) SELECT {values} FROM {table}_legacy '
+                'WHERE task_id IS NULL OR CAST(task_id AS INTEGER) IN (SELECT id FROM task)'.format(
+                    table=table_name, columns=', '.join(columns),
+                    values=', '.join('CAST(task_id AS INTEGER)' if column == 'task_id' else column
+                                     for column in columns)))
+            connection.exec_driver_sql('DROP TABLE {0}_legacy'.format(table_name))
+
+
+def sync_schema(db):
+    """Migrate the database, create missing tables, then add missing columns and indexes.
+
+    Args:
+        db: The Flask-SQLAlchemy instance.
+    """
+    inspector = inspect(db.engine)
+    table_names = inspector.get_table_names()
+    if 'task' in table_names and 'task_instance' not in table_names:
+        _split_task_instances(db, inspector)
+        inspector = inspect(db.engine)
+    _convert_task_id_columns(db, inspector)
+
+    db.create_all()
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                column_ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                with db.engine.begin() as connection:
+                    connection.exec_driver_sql('ALTER TABLE %s ADD COLUMN %s' % (table.name, column_ddl))
+        for table_index in table.indexes:
+            table_index.create(bind=db.engine, checkfirst=True)
@@ -0,0 +1,112 @@
+"""Task search - Habitica To Do Over tool
+
+Full-text search over Task.name and Task.notes with an SQLite FTS5
+index. The index is an external content table over the task table, kept
+in sync by triggers, so every path that writes tasks (the views, the
+scheduler, imports and the admin) updates it without extra code. The
+trigram tokenizer matches any substring of three characters or more,
+which also works for Chinese text without word breaks. Shorter terms,
+and databases without FTS5, fall back to LIKE on the user's tasks.
+"""
+from __future__ import absolute_import
+
+from sqlalchemy import or_, text
+from sqlalchemy.exc import OperationalError
+
+from models import Task, task_tag
+
+FTS_TABLE = 'task_fts'
+MIN_FTS_TERM = 3
+
+_fts_enabled = False
+
+_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS task_fts_insert AFTER INSERT ON task BEGIN
+        INSERT INTO task_fts(rowid, name, notes) VALUES (new.id, new.name, new.notes);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_fts_delete AFTER DELETE ON task BEGIN
+        INSERT INTO task_fts(task_fts, rowid, name, notes) VALUES ('delete', old.id, old.name, old.notes);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_fts_update AFTER UPDATE OF name, notes ON task BEGIN
+        INSERT INTO task_fts(task_fts, rowid, name, notes) VALUES ('delete', old.id, old.name, old.notes);
+        INSERT INTO task_fts(rowid, name, notes) VALUES (new.id, new.name, new.notes);
+    END""",
+)
+
+
+def init_search(db):
+    """Create the FTS index and its triggers if they don't exist.
+
+    A new index is filled from the existing tasks. Does nothing on other
+    databases or SQLite builds without FTS5 and the trigram tokenizer,
+    search then uses LIKE only.
+
+    Args:
+        db: The Flask-SQLAlchemy instance.
+    """
+    global _fts_enabled
+    if db.engine.dialect.name != 'sqlite':
+        return
+    with db.engine.begin() as connection:
+        exists = connection.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                                    {'name': FTS_TABLE}).first()
+        try:
+            if not exists:
+                connection.exec_driver_sql(
+                    "CREATE VIRTUAL TABLE task_fts USING fts5("
+                    "name, notes, content='task', content_rowid='id', tokenize='trigram')")
+                connection.exec_driver_sql("INSERT INTO task_fts(task_fts) VALUES ('rebuild')")
+            for trigger in _TRIGGERS:
+                connection.exec_driver_sql(trigger)
+        except OperationalError as error:
+            # 没有 FTS5 或 trigram 分词器的 SQLite 只能用 LIKE 搜索
+            print('full-text search disabled: %s' % error)
+            return
+    _fts_enabled = True
+
+
+def rebuild_search_index(db):
+    """Rebuild the FTS index from the task table.
+
+    Only needed if the task table was written with the triggers missing,
+    e.g. by a restore from an older backup.
+    """
+    if _fts_enabled:
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql("INSERT INTO task_fts(task_fts) VALUES ('rebuild')")
+
+
+def _quote(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+def search_tasks(owner, query=None, tag_ids=None):
+    """Build the query for a user's tasks matching a search and tags.
+
+    Args:
+        owner: ID of the user.
+        query: Search text. Every whitespace separated term must appear
+            in the name or the notes.
+        tag_ids: Tag IDs, the tasks must have all of them.
+
+    Returns:
+        A Task query ordered by name, ready to be paginated.
+    """
+    tasks = Task.query.filter(Task.owner == owner)
+
+    terms = (query or '').split()
+    fts_terms = [term for term in terms if _fts_enabled and len(term) >= MIN_FTS_TERM]
+    if fts_terms:
+        tasks = tasks.filter(text('task.id IN (SELECT rowid FROM task_fts WHERE task_fts MATCH :match)')
+                             .bindparams(match=' '.join(_quote(term) for term in fts_terms)))
+    for term in terms:
+        if term not in fts_terms:
+            pattern = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            tasks = tasks.filter(or_(Task.name.like(pattern, escape='\\'), Task.notes.like(pattern, escape='\\')))
+
+    for tag_id in tag_ids or []:
+        # task_tag 的 tag_id 索引让每个标签只读取带这个标签的任务
+        tasks = tasks.filter(Task.id.in_(task_tag.select().with_only_columns(task_tag.c.task_id)
+                                         .where(task_tag.c.tag_id == tag_id)))
+
+    return tasks.order_by(Task.name, Task.id)
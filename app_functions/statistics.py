@@ -0,0 +1,147 @@
+"""Completion statistics - Habitica To Do Over tool
+
+The scheduler appends a TaskEvent for every completion, recreation and
+missed rule fire it sees. Recording an event also updates the task's
+TaskStat row and the day and week StatRollup rows in the same
+transaction, so the data panel only reads these aggregates and never
+scans the event log.
+"""
+from __future__ import absolute_import
+
+from datetime import datetime, timedelta
+
+from extensions import db
+from models import StatRollup, TaskEvent, TaskStat
+
+HABITICA_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, HABITICA_DATE_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+def _get_stat(task):
+    stat = TaskStat.query.get(task.get_series_id())
+    if stat is None:
+        stat = TaskStat(series_id=task.get_series_id(), owner=task.owner, completions=0, recreations=0, misses=0,
+                        timed_completions=0, total_duration=0, current_streak=0, best_streak=0)
+        db.session.add(stat)
+    stat.name = task.name
+    return stat
+
+
+def _add_to_rollups(owner, at, completions=0, recreations=0):
+    day = at.date()
+    table = StatRollup.__table__
+    for period, start in (('day', day), ('week', day - timedelta(days=day.weekday()))):
+        result = db.session.execute(
+            table.update()
+            .where(table.c.owner == owner).where(table.c.period == period).where(table.c.start == start)
+            .values(completions=table.c.completions + completions, recreations=table.c.recreations + recreations))
+        if result.rowcount == 0:
+            db.session.execute(table.insert().values(owner=owner, period=period, start=start,
+                                                     completions=completions, recreations=recreations))
+
+
+def record_recreation(task, task_json, now=None):
+    """Record that a completed task instance was recreated.
+
+    Adds a completed event at Habitica's completion time, with the time
+    it took from creation to completion, and a recreated event. Nothing
+    is committed, the caller commits together with the new task.
+
+    Args:
+        task: The task that was completed.
+        task_json: The task's data from Habitica.
+        now: Naive UTC datetime of the recreation.
+    """
+    now = now or datetime.utcnow()
+    completed_at = _parse_date(task_json.get('dateCompleted')) or now
+    created_at = _parse_date(task_json.get('createdAt'))
+    duration = int((completed_at - created_at).total_seconds()) if created_at else None
+    if duration is not None and duration < 0:
+        duration = None
+    series_id = task.get_series_id()
+    db.session.add(TaskEvent(owner=task.owner, series_id=series_id, kind='completed', at=completed_at,
+                             duration=duration))
+    db.session.add(TaskEvent(owner=task.owner, series_id=series_id, kind='recreated', at=now))
+
+    stat = _get_stat(task)
+    stat.completions += 1
+    stat.recreations += 1
+    if duration is not None:
+        stat.timed_completions += 1
+        stat.total_duration += duration
+    stat.current_streak += 1
+    stat.best_streak = max(stat.best_streak, stat.current_streak)
+    stat.last_completed = max(stat.last_completed or completed_at, completed_at)
+
+    _add_to_rollups(task.owner, completed_at, completions=1)
+    _add_to_rollups(task.owner, now, recreations=1)
+
+
+def record_miss(task, now=None):
+    """Record that a rule task was due while its instance was still open.
+
+    This ends the task's streak. Nothing is committed.
+    """
+    db.session.add(TaskEvent(owner=task.owner, series_id=task.get_series_id(), kind='missed',
+                             at=now or datetime.utcnow()))
+    stat = _get_stat(task)
+    stat.misses += 1
+    stat.current_streak = 0
+
+
+def get_day_streak(owner, today=None):
+    """Get the number of consecutive days up to today with a completion.
+
+    A streak that ended yesterday still counts, today may not be done yet.
+    """
+    today = today or datetime.utcnow().date()
+    days = {start for (start,) in db.session.query(StatRollup.start).filter(
+        StatRollup.owner == owner, StatRollup.period == 'day', StatRollup.completions > 0,
+        StatRollup.start <= today).order_by(StatRollup.start.desc()).limit(366)}
+    day = today if today in days else today - timedelta(days=1)
+    streak = 0
+    while day in days:
+        streak += 1
+        day -= timedelta(days=1)
+    return streak
+
+
+def get_statistics(owner, today=None, days=14, weeks=8):
+    """Get the data panel of a user from the aggregates.
+
+    Args:
+        owner: ID of the user.
+        today: UTC date, defaults to today.
+        days: Number of days in the daily chart.
+        weeks: Number of weeks in the weekly chart.
+
+    Returns:
+        Dict with the per task stats, the totals, the day streak and the
+        daily and weekly completion and recreation counts, oldest first.
+    """
+    today = today or datetime.utcnow().date()
+    stats = TaskStat.query.filter(TaskStat.owner == owner).order_by(TaskStat.completions.desc(),
+                                                                    TaskStat.name).all()
+
+    def series(period, starts):
+        rows = {row.start: row for row in StatRollup.query.filter(
+            StatRollup.owner == owner, StatRollup.period == period, StatRollup.start >= starts[0])}
+        return [(start, rows[start].completions if start in rows else 0,
+                 rows[start].recreations if start in rows else 0) for start in starts]
+
+    this_week = today - timedelta(days=today.weekday())
+    return {
+        'tasks': stats,
+        'completions': sum(stat.completions for stat in stats),
+        'recreations': sum(stat.recreations for stat in stats),
+        'best_streak': max([stat.best_streak for stat in stats] or [0]),
+        'day_streak': get_day_streak(owner, today),
+        'daily': series('day', [today - timedelta(days=i) for i in range(days - 1, -1, -1)]),
+        'weekly': series('week', [this_week - timedelta(weeks=i) for i in range(weeks - 1, -1, -1)]),
+    }
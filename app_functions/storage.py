@@ -0,0 +1,112 @@
+"""Storage profiles - Habitica To Do Over tool
+
+The database is chosen by DATABASE_PROFILE in the config:
+
+    sqlite  The SQLite file at SQLALCHEMY_DATABASE_PATH. Connections are
+            kept in a small pool and every new connection gets the
+            SQLITE_* pragmas: journal mode, busy timeout, synchronous
+            level and memory mapping. New files are created with
+            incremental auto vacuum for the maintenance job.
+    server  A database server at DATABASE_URL, e.g. PostgreSQL or MySQL,
+            through a connection pool sized by the DATABASE_POOL_*
+            settings. Use it when several instances share the data.
+
+init_storage takes the place of db.init_app, so the URI and the engine
+options are set before Flask-SQLAlchemy creates the engine.
+"""
+from __future__ import absolute_import
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+PROFILE_SQLITE = 'sqlite'
+PROFILE_SERVER = 'server'
+
+
+def get_engine_options(config):
+    """Get the URI and the SQLAlchemy engine options of the configured profile.
+
+    Args:
+        config: The Flask config.
+
+    Returns:
+        Tuple of the database URI and the engine options dict.
+
+    Raises:
+        ValueError: The profile is unknown, or the server profile has no
+            DATABASE_URL.
+    """
+    profile = config.get('DATABASE_PROFILE', PROFILE_SQLITE)
+    if profile == PROFILE_SQLITE:
+        # SQLAlchemy 1.4 opens a new connection for every session on a
+        # SQLite file; a pool keeps the connections, their page cache and
+        # pragmas between requests. A connection is only used by one
+        # thread at a time, so it may move between threads. SQLite has no
+        # connection limit, so threads never wait for the pool: extra
+        # connections are opened as needed and closed when returned.
+        return 'sqlite:///' + config['SQLALCHEMY_DATABASE_PATH'], {
+            'poolclass': QueuePool,
+            'pool_size': config.get('SQLITE_POOL_SIZE', 16),
+            'max_overflow': -1,
+            'connect_args': {'check_same_thread': False},
+        }
+    if profile == PROFILE_SERVER:
+        if not config.get('DATABASE_URL'):
+            raise ValueError('DATABASE_PROFILE is server but DATABASE_URL is not set')
+        return config['DATABASE_URL'], {
+            'pool_size': config.get('DATABASE_POOL_SIZE', 10),
+            'max_overflow': config.get('DATABASE_MAX_OVERFLOW', 10),
+            'pool_timeout': config.get('DATABASE_POOL_TIMEOUT', 30),
+            'pool_recycle': config.get('DATABASE_POOL_RECYCLE', 1800),
+            'pool_pre_ping': True,
+        }
+    raise ValueError('unknown DATABASE_PROFILE %r' % profile)
+
+
+def get_sqlite_pragmas(config):
+    """Get the pragmas run on every new SQLite connection, in order."""
+    return [
+        # Only takes effect on a new file, or on the next full VACUUM
+        ('auto_vacuum', 'INCREMENTAL'),
+        ('busy_timeout', int(config.get('SQLITE_BUSY_TIMEOUT', 5000))),
+        ('journal_mode', config.get('SQLITE_JOURNAL_MODE', 'WAL')),
+        ('synchronous', config.get('SQLITE_SYNCHRONOUS', 'NORMAL')),
+        ('mmap_size', int(config.get('SQLITE_MMAP_SIZE', 0))),
+    ]
+
+
+def set_sqlite_pragmas(dbapi_connection, pragmas):
+    """Run pragmas on a DB-API SQLite connection."""
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+    finally:
+        cursor.close()
+
+
+def init_storage(app, db):
+    """Configure the database of app from its storage profile.
+
+    Sets SQLALCHEMY_DATABASE_URI and SQLALCHEMY_ENGINE_OPTIONS, then
+    initializes db, and for SQLite registers the pragmas on the engine.
+
+    Args:
+        app: The Flask app.
+        db: The Flask-SQLAlchemy instance.
+    """
+    uri, options = get_engine_options(app.config)
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}, **options)
+    db.init_app(app)
+
+    if app.config.get('DATABASE_PROFILE', PROFILE_SQLITE) == PROFILE_SQLITE:
+        pragmas = get_sqlite_pragmas(app.config)
+        with app.app_context():
+            event.listen(db.engine, 'connect', lambda dbapi_connection, record: set_sqlite_pragmas(
+                dbapi_connection, pragmas))
+
+
+def is_sqlite(db):
+    """Whether db is stored in SQLite."""
+    return db.engine.dialect.name == 'sqlite'
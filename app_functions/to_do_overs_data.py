@@ -14,10 +14,117 @@ __license__ = "MIT"
 from datetime import datetime, timedelta
 import requests
 
+try:
+    import ijson
+except ImportError:  # ijson is in requirements.txt, without it (development only) responses are parsed whole
+    ijson = None
+
 from extensions import db
-from models import User, Tag
+from models import User, Tag, task_tag
+from .checklist import get_checklist_diff
+from .jobs import check_lease
 from .cipher_functions import encrypt_text, decrypt_text, CIPHER_FILE
 
+# Seconds to wait for Habitica to accept the connection and to answer, must stay
+# well below half of SCHEDULED_LEASE_TTL, see app_functions/jobs.py
+HABITICA_TIMEOUT = (5, 30)
+
+# Fields of Habitica's task data that are kept, the rest (notes,
+# checklist, history...) is dropped while the response is parsed
+TASK_STATUS_FIELDS = ('id', 'completed', 'dateCompleted')
+# The scheduler also records how long a task took, from createdAt
+TASK_FIELDS = TASK_STATUS_FIELDS + ('createdAt',)
+
+_SCALAR_EVENTS = ('string', 'number', 'boolean', 'null')
+
+
+class HabiticaSession(requests.Session):
+    """Shared HTTP session for Habitica requests.
+
+    Keeps connections to Habitica alive between requests of all threads
+    instead of opening one per call, and never waits on Habitica forever,
+    so a slow call can't hold a server thread indefinitely. In a
+    background job, no request is sent after the job lost its lease.
+    """
+
+    def __init__(self, pool_size=32):
+        super(HabiticaSession, self).__init__()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        check_lease()
+        kwargs.setdefault('timeout', HABITICA_TIMEOUT)
+        return super(HabiticaSession, self).request(method, url, **kwargs)
+
+
+habitica_session = HabiticaSession()
+
+
+class _ContentReader(object):
+    # File-like view of iter_content for ijson, which decodes gzip and raises the requests exceptions
+    def __init__(self, response, chunk_size=65536):
+        self._chunks = response.iter_content(chunk_size)
+
+    def read(self, size=-1):
+        # ijson reads 0 bytes first to tell bytes from text
+        return next(self._chunks, b'') if size else b''
+
+
+def _iter_objects(response, prefix, fields):
+    # Only build the wanted fields of the current object
+    current = None
+    try:
+        for path, event, value in ijson.parse(_ContentReader(response)):
+            if path == prefix:
+                if event == 'start_map':
+                    current = {}
+                elif event == 'end_map' and current is not None:
+                    yield current
+                    current = None
+            elif current is not None and event in _SCALAR_EVENTS and path.startswith(prefix + '.'):
+                key = path[len(prefix) + 1:]
+                if key in fields:
+                    current[key] = value
+    except ijson.JSONError as exception:
+        # Like response.json()
+        raise ValueError(str(exception))
+
+
+def iter_response_items(response, fields):
+    """Iterate over the items of a Habitica list response, keeping only fields.
+
+    With ijson installed the body is decoded while it is read, so only
+    one chunk and one item are in memory at a time, however long the
+    list is. Make the request with stream=True.
+
+    Args:
+        response: Response whose body is {"data": [...]}.
+        fields: Names of the item fields to keep.
+
+    Yields:
+        Dicts with the fields the item has.
+    """
+    if ijson is not None:
+        for item in _iter_objects(response, 'data.item', fields):
+            yield item
+    else:
+        for item in response.json()['data']:
+            yield {key: item[key] for key in fields if key in item}
+
+
+def read_response_data(response, fields):
+    """Get the data object of a Habitica response, keeping only fields.
+
+    See iter_response_items.
+    """
+    if ijson is not None:
+        for data in _iter_objects(response, 'data', fields):
+            return data
+        return {}
+    data = response.json()['data']
+    return {key: data[key] for key in fields if key in data}
+
 
 class ToDoOversData(object):
     """Session data and application functions that don't fall in models or views.
@@ -33,6 +140,8 @@ class ToDoOversData(object):
         task_days (int): The number of days that a task should last
             before expiring for the task being created.
         task_id (str): The created task ID from Habitica.
+        checklist (list): The checklist items, {'id', 'text'}, of the
+            created or edited task on Habitica.
         priority (str): Difficulty of the task being created.
             See models.py for choices.
         notes (str): The description/notes of the task being created.
@@ -50,6 +159,7 @@ class ToDoOversData(object):
         self.task_days = 0
         self.task_delay = 0
         self.task_id = ''
+        self.checklist = []
         self.priority = ''
         self.notes = ''
 
@@ -64,7 +174,7 @@ class ToDoOversData(object):
         Returns:
             True for success, False for failure.
         """
-        req = requests.post(
+        req = habitica_session.post(
             'https://habitica.com/api/v3/user/auth/local/login',
             data={'username': username, 'password': password}
         )
@@ -105,7 +215,9 @@ class ToDoOversData(object):
             'Content-Type': 'application/json'
         }
 
-        req = requests.get('https://habitica.com/api/v3/user', headers=headers)
+        # Without userFields Habitica sends the whole user document, with inventory and history
+        req = habitica_session.get('https://habitica.com/api/v3/user', headers=headers,
+                                   params={'userFields': 'profile.name'})
         self.return_code = req.status_code
         if req.status_code == 200:
             req_json = req.json()
@@ -123,9 +235,16 @@ class ToDoOversData(object):
             return True
         return False
 
-    def create_task(self, user_id, api_token, task_name, notes, task_days, priority, tags,
+    def create_task(self, user_id, api_token, task_name, notes, task_days, priority, tags, checklist=None,
                     cipher_file_path=CIPHER_FILE):
         """Create a task on Habitica.
+
+        The checklist is sent inline as JSON, so the task and all its
+        items are created by one request.
+
+        Args:
+            checklist: List of the texts of the checklist items.
+
         Returns:
             True for success, False for failure.
         """
@@ -137,46 +256,30 @@ class ToDoOversData(object):
             ).decode()
         }
 
+        payload = {
+            'text': task_name,
+            'type': 'todo',
+            'notes': notes,
+            'priority': priority,
+            'tags': tags,
+            'checklist': [{'text': text} for text in checklist or []],
+        }
         if int(task_days) > 0:
             due_date = datetime.now() + timedelta(days=int(task_days))
-            due_date = due_date.isoformat()
+            payload['date'] = due_date.isoformat()
 
-            req = requests.post(
-                'https://habitica.com/api/v3/tasks/user',
-                headers=headers,
-                data={
-                    'text': task_name,
-                    'type': 'todo',
-                    'notes': notes,
-                    'date': due_date,
-                    'priority': priority,
-                    'tags': tags,
-                }
-            )
-            self.return_code = req.status_code
-            if req.status_code == 201:
-                req_json = req.json()
-                self.task_id = req_json['data']['id']
-                return True
-            return False
-        else:
-            req = requests.post(
-                'https://habitica.com/api/v3/tasks/user',
-                headers=headers,
-                data={
-                    'text': task_name,
-                    'type': 'todo',
-                    'notes': notes,
-                    'priority': priority,
-                    'tags': tags,
-                }
-            )
-            self.return_code = req.status_code
-            if req.status_code == 201:
-                req_json = req.json()
-                self.task_id = req_json['data']['id']
-                return True
-            return False
+        req = habitica_session.post(
+            'https://habitica.com/api/v3/tasks/user',
+            headers=headers,
+            json=payload
+        )
+        self.return_code = req.status_code
+        if req.status_code == 201:
+            req_json = req.json()
+            self.task_id = req_json['data']['id']
+            self.checklist = self._get_checklist(req_json['data'])
+            return True
+        return False
 
     def edit_task(self, user_id, api_token, task_id, task_name, notes, task_days, priority, tags,
                   cipher_file_path=CIPHER_FILE):
@@ -193,7 +296,7 @@ class ToDoOversData(object):
             due_date = datetime.now() + timedelta(days=int(task_days))
             due_date = due_date.isoformat()
 
-            req = requests.put(url, headers=headers, data={
+            req = habitica_session.put(url, headers=headers, data={
                 'text': task_name,
                 'notes': notes,
                 'date': due_date,
@@ -207,7 +310,7 @@ class ToDoOversData(object):
                 return True
             return False
         else:
-            req = requests.put(url, headers=headers, data={
+            req = habitica_session.put(url, headers=headers, data={
                 'text': task_name,
                 'notes': notes,
                 'priority': priority,
@@ -221,6 +324,109 @@ class ToDoOversData(object):
             else:
                 return False
 
+    def edit_checklist(self, user_id, api_token, task_id, items, texts, cipher_file_path=CIPHER_FILE):
+        """Change the checklist of a task on Habitica to texts.
+
+        Only the added, removed and renamed items are sent, one request
+        each, see get_checklist_diff. self.checklist follows Habitica's
+        checklist after every request, also when a later one fails, so
+        a retry carries on from there.
+
+        Args:
+            task_id: The Habitica ID of the task.
+            items: List of {'id', 'text'} of the checklist on Habitica.
+            texts: The wanted item texts.
+
+        Returns:
+            True for success, False for failure.
+        """
+        headers = {
+            'x-api-user': user_id,
+            'x-api-key': decrypt_text(
+                api_token,
+                cipher_file_path
+            ).decode()
+        }
+        url = 'https://habitica.com/api/v3/tasks/' + str(task_id) + '/checklist'
+
+        self.checklist = list(items)
+        renames, removes, adds = get_checklist_diff(items, texts)
+        calls = [('put', url + '/' + item_id, {'text': text}) for item_id, text in renames]
+        calls += [('delete', url + '/' + item_id, None) for item_id in removes]
+        calls += [('post', url, {'text': text}) for text in adds]
+        for method, item_url, payload in calls:
+            req = habitica_session.request(method, item_url, headers=headers, json=payload)
+            self.return_code = req.status_code
+            if req.status_code not in (200, 201):
+                return False
+            # Every checklist route answers with the whole task
+            self.checklist = self._get_checklist(req.json()['data'])
+        return True
+
+    @staticmethod
+    def _get_checklist(task_json):
+        return [{'id': item['id'], 'text': item['text']} for item in task_json.get('checklist') or []]
+
+    def get_task(self, user_id, api_token, task_id, cipher_file_path=CIPHER_FILE):
+        """Get a task from Habitica.
+
+        Returns:
+            Dict of the task's TASK_FIELDS for success, False for failure.
+        """
+        headers = {
+            'x-api-user': user_id,
+            'x-api-key': decrypt_text(
+                api_token,
+                cipher_file_path
+            ).decode()
+        }
+
+        with habitica_session.get('https://habitica.com/api/v3/tasks/' + str(task_id), headers=headers,
+                                  stream=True) as req:
+            self.return_code = req.status_code
+            if req.status_code == 200:
+                return read_response_data(req, TASK_FIELDS)
+        return False
+
+    def get_user_task_status(self, user_id, api_token, cipher_file_path=CIPHER_FILE):
+        """Get the completion status of all of a user's todos.
+
+        Habitica lists open and completed todos separately, so this
+        makes one list call for each instead of one call per task.
+        Only the most recently completed todos are returned by Habitica.
+        The lists are streamed, see iter_response_items, so a user with
+        thousands of todos doesn't need their whole data in memory.
+
+        Returns:
+            Dict of task ID to {'completed', 'dateCompleted'} for success,
+            False for failure.
+        """
+        headers = {
+            'x-api-user': user_id,
+            'x-api-key': decrypt_text(
+                api_token,
+                cipher_file_path
+            ).decode()
+        }
+
+        statuses = {}
+        for task_type in ('todos', 'completedTodos'):
+            with habitica_session.get(
+                'https://habitica.com/api/v3/tasks/user',
+                headers=headers,
+                params={'type': task_type},
+                stream=True
+            ) as req:
+                self.return_code = req.status_code
+                if req.status_code != 200:
+                    return False
+                for task_json in iter_response_items(req, TASK_STATUS_FIELDS):
+                    statuses[task_json['id']] = {
+                        'completed': task_json.get('completed', False),
+                        'dateCompleted': task_json.get('dateCompleted'),
+                    }
+        return statuses
+
     def get_user_tags(self, user_id, api_token, cipher_file_path=CIPHER_FILE):
         """Get the list of a user's tags.
 
@@ -235,7 +441,7 @@ class ToDoOversData(object):
             )
         }
 
-        req = requests.get(
+        req = habitica_session.get(
             'https://habitica.com/api/v3/tags',
             headers=headers,
             data={}
@@ -267,10 +473,11 @@ class ToDoOversData(object):
                     if tag_json['id'] in current_tag_ids:
                         current_tag_ids.remove(tag_json['id'])
 
-                for leftover_tag in current_tag_ids:
-                    print('deleting tag ' + leftover_tag)
-                    tag = Tag.query.filter(Tag.id == leftover_tag)
-                    db.session.delete(tag)
+                if current_tag_ids:
+                    # Tags deleted on Habitica, together with their task links
+                    print('deleting tags ' + ', '.join(current_tag_ids))
+                    db.session.execute(task_tag.delete().where(task_tag.c.tag_id.in_(current_tag_ids)))
+                    Tag.query.filter(Tag.id.in_(current_tag_ids)).delete(synchronize_session=False)
                     db.session.commit()
 
                 return req_json['data']
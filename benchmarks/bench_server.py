@@ -0,0 +1,85 @@
+"""Server throughput benchmark - Habitica To Do Over tool
+
+Measures requests per second and latency of a running server under a
+number of concurrent clients, to compare serving modes, e.g.:
+
+    python3 app.py                                   # development server
+    ENV=prod gunicorn -c gunicorn.conf.py app:app    # production server
+    python3 benchmarks/bench_server.py --url http://127.0.0.1:9000/ --clients 32
+
+Only the standard library is used, so it runs anywhere the app runs.
+"""
+from __future__ import print_function
+
+import argparse
+import threading
+import time
+
+from urllib.error import URLError
+from urllib.request import Request, urlopen
+
+
+def run_client(url, headers, deadline, latencies, errors):
+    while time.time() < deadline:
+        started = time.time()
+        try:
+            response = urlopen(Request(url, headers=headers), timeout=60)
+            response.read()
+            latencies.append(time.time() - started)
+        except (URLError, IOError):
+            errors.append(time.time() - started)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def benchmark(url, clients, duration, headers=None):
+    """Load url with concurrent clients for duration seconds.
+
+    Returns:
+        Dict with the number of requests and errors, the requests per
+        second and the p50/p95/p99 latencies in milliseconds.
+    """
+    latencies, errors = [], []
+    deadline = time.time() + duration
+    threads = [threading.Thread(target=run_client, args=(url, headers or {}, deadline, latencies, errors))
+               for _ in range(clients)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': len(latencies) / elapsed,
+        'p50': percentile(latencies, 0.5) * 1000,
+        'p95': percentile(latencies, 0.95) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default='http://127.0.0.1:9000/')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--cookie', help='Cookie header, to benchmark pages that need a login')
+    args = parser.parse_args()
+
+    headers = {'Cookie': args.cookie} if args.cookie else {}
+    print('clients   requests  errors      req/s   p50 ms   p95 ms   p99 ms')
+    for clients in args.clients:
+        result = benchmark(args.url, clients, args.duration, headers)
+        print('%7d %10d %7d %10.1f %8.1f %8.1f %8.1f' % (
+            clients, result['requests'], result['errors'], result['rps'], result['p50'], result['p95'],
+            result['p99']))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,7 @@
 from flask_sqlalchemy import SQLAlchemy
 
+from app_functions.cache import TTLCache
+
 db = SQLAlchemy()
+user_cache = TTLCache()
+task_status_cache = TTLCache()
@@ -1,11 +1,12 @@
 # 引入Form基类
 from flask_babel import lazy_gettext as _l
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired
 # 引入Form元素父类
-from wtforms import StringField, PasswordField, SubmitField, widgets
+from wtforms import StringField, PasswordField, SubmitField, BooleanField, widgets
 from wtforms import TextAreaField, SelectMultipleField, SelectField, IntegerField
 # 引入Form验证父类
-from wtforms.validators import DataRequired, InputRequired, NumberRange
+from wtforms.validators import DataRequired, InputRequired, NumberRange, Optional
 
 
 class Login(FlaskForm):
@@ -33,5 +34,40 @@ class TasksModelForm(FlaskForm):
     days = IntegerField(_l('分配完成任务的天数（输入 0 表示没有截止日期）：'), validators=[InputRequired(), NumberRange(min=0)], default=0)
     delay = IntegerField(_l('重新创建任务之前延迟的天数（输入 0 表示没有延迟）：'), validators=[InputRequired(), NumberRange(min=0)], default=0)
     checklist = TextAreaField(_l(u'子任务：'), render_kw={'placeholder': _l(u'输入子任务（可选，每一行为一个子任务）')})
+    rule_choices = [('completion', _l('完成后重新创建')), ('weekly', _l('每周')), ('monthly', _l('每月')),
+                    ('interval', _l('每隔几天'))]
+    weekday_choices = [('0', _l('周一')), ('1', _l('周二')), ('2', _l('周三')), ('3', _l('周四')), ('4', _l('周五')),
+                       ('5', _l('周六')), ('6', _l('周日'))]
+    rule = SelectField(_l('重复规则：'), choices=rule_choices, default='completion')
+    rule_weekdays = MultiCheckboxField(_l('每周的哪几天（每周）：'), choices=weekday_choices, default=[])
+    rule_monthday = IntegerField(_l('每月的哪一天（每月）：'), validators=[Optional(), NumberRange(min=1, max=31)])
+    rule_interval = IntegerField(_l('间隔天数（每隔几天）：'), validators=[Optional(), NumberRange(min=1)])
     tags = MultiCheckboxField(_l('标签：'), choices=[], default=['0.1', '1.0'])
     submit = SubmitField(_l('提交'))
+
+
+class BulkTasksForm(FlaskForm):
+    action = SelectField(_l('批量操作：'), choices=[('edit', _l('修改')), ('delete', _l('删除'))], default='edit')
+    priority = SelectField(_l('难度：'), choices=[('', _l('不修改'))] + TasksModelForm.choices, default='')
+    days = IntegerField(_l('完成任务的天数：'), validators=[Optional(), NumberRange(min=0)],
+                        render_kw={'placeholder': _l('留空表示不修改')})
+    delay = IntegerField(_l('延迟的天数：'), validators=[Optional(), NumberRange(min=0)],
+                         render_kw={'placeholder': _l('留空表示不修改')})
+    set_tags = BooleanField(_l('修改标签'))
+    tags = MultiCheckboxField(_l('标签：'), choices=[])
+    submit = SubmitField(_l('提交'))
+
+
+class SearchForm(FlaskForm):
+    class Meta:
+        # 搜索用 GET 请求，不需要 CSRF 令牌
+        csrf = False
+
+    q = StringField(_l('搜索：'), render_kw={'placeholder': _l('搜索任务名称或备注')})
+    tags = MultiCheckboxField(_l('标签：'), choices=[])
+    submit = SubmitField(_l('搜索'))
+
+
+class ImportForm(FlaskForm):
+    file = FileField(_l('数据文件：'), validators=[FileRequired(message=_l('请选择要导入的文件'))])
+    submit = SubmitField(_l('导入'))
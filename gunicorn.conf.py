@@ -0,0 +1,35 @@
+# gunicorn 配置，生产环境通过 scf_bootstrap 使用：gunicorn -c gunicorn.conf.py app:app
+import multiprocessing
+import os
+
+# HTTP 直通函数由于是基于 docker 镜像运行，所以必须监听地址为 0.0.0.0，并且端口为 9000
+bind = '0.0.0.0:' + os.getenv('PORT', '9000')
+
+# 每个 worker 用多个线程处理请求，等待 Habitica 响应的请求不会阻塞其他请求
+worker_class = 'gthread'
+workers = int(os.getenv('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 4)))
+threads = int(os.getenv('GUNICORN_THREADS', 16))
+
+# 在 master 进程中加载应用，数据库结构同步、搜索索引和资源构建只做一次，worker 之间共享内存
+preload_app = True
+
+# 请求超过 timeout 秒没有响应的 worker 会被重启；收到 SIGTERM 后最多等待 graceful_timeout 秒完成正在处理的请求
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # master 进程中打开的数据库连接不能在 fork 出来的 worker 中继续使用
+    from extensions import db
+    db.engine.dispose()
+
+
+def worker_exit(server, worker):
+    # 等待这个 worker 启动的定时任务结束，超时后租约会过期，由下一次运行接手
+    from app_functions.jobs import wait_for_jobs
+    if not wait_for_jobs(graceful_timeout):
+        worker.log.warning('scheduled job still running at shutdown, its lease will expire')
@@ -1,4 +1,10 @@
+import json
+from datetime import datetime
+
 from extensions import db
+from sqlalchemy import event
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.orm import Session
 from flask_login import UserMixin
 from flask_babel import gettext as _
 
@@ -10,7 +16,7 @@ class User(UserMixin, db.Model):
     id = db.Column(db.String(255), primary_key=True)
     role = db.Column(db.String(32), default=ROLES[0])
     api_token = db.Column(db.String(255))
-    username = db.Column(db.String(64))
+    username = db.Column(db.String(64), index=True)
     tags = db.relationship("Tag", backref="users")
     language = db.Column(db.String(32), default="zh")
 
@@ -29,8 +35,10 @@ class User(UserMixin, db.Model):
 
 task_tag = db.Table("task_tag",
                     # 定义两个外键，是两个多对多文章的主键
-                    db.Column("task_id", db.String(255), db.ForeignKey("task.id"), primary_key=True),
-                    db.Column("tag_id", db.String(255), db.ForeignKey("tag.id"), primary_key=True)
+                    db.Column("task_id", db.Integer, db.ForeignKey("task.id"), primary_key=True),
+                    db.Column("tag_id", db.String(255), db.ForeignKey("tag.id"), primary_key=True),
+                    # 主键以 task_id 开头，按标签筛选任务需要单独的 tag_id 索引
+                    db.Index("ix_task_tag_tag_id", "tag_id")
                     )
 
 
@@ -47,25 +55,88 @@ class Tag(db.Model):
 
 
 class Task(db.Model):
+    """定期任务的模板，ID 不随重新创建变化；当前在 Habitica 上的任务见 TaskInstance"""
     __tablename__ = 'task'
+    __table_args__ = (
+        db.Index('ix_task_owner_priority', 'owner', 'priority'),
+        db.Index('ix_task_owner_id', 'owner', 'id'),
+    )
     PRIORITY_CHOICES = {'0.1': '琐事', '1.0': '简单', '1.5': '中等', '2.0': '困难'}
+    RULES = {'completion': '完成后重新创建', 'weekly': '每周', 'monthly': '每月', 'interval': '每隔几天'}
 
-    id = db.Column(db.String(255), primary_key=True)
-    name = db.Column(db.String(255))
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True, nullable=False)
+    name = db.Column(db.String(255), index=True)
     notes = db.Column(db.Text())
-    priority = db.Column(db.String(255), default='1.0')
+    priority = db.Column(db.String(255), default='1.0', index=True)
     days = db.Column(db.Integer, default=0)
     delay = db.Column(db.Integer, default=0)
     owner = db.Column(db.String(255), db.ForeignKey('user.id'))
     tags = db.relationship('Tag', backref="tasks", secondary=task_tag)
+    instance = db.relationship('TaskInstance', backref='task', uselist=False, lazy='joined',
+                               cascade='all, delete-orphan')
+    # SQLite 默认不检查外键，ON DELETE CASCADE 不会执行，删除任务时由 ORM 删除队列中的操作
+    retry_items = db.relationship('RetryItem', backref='task', cascade='all')
+    dead_letters = db.relationship('DeadLetter', backref='task', cascade='all')
+    # 重复规则，除了完成后重新创建，其余规则按日期定时创建，见 app_functions/recurrence.py
+    rule = db.Column(db.String(32), default='completion', server_default='completion')
+    rule_weekdays = db.Column(db.String(32))  # 每周的哪几天，0 表示周一，如 '0,2,4'
+    rule_monthday = db.Column(db.Integer)  # 每月的哪一天
+    rule_interval = db.Column(db.Integer)  # 每隔几天
+    rule_anchor = db.Column(db.DateTime)  # 每隔几天的起始日期
+    next_fire = db.Column(db.DateTime, index=True)  # 下次按规则创建的时间，完成后重新创建的任务为空
+    checklist = db.Column(db.Text())  # 子任务文本的 JSON 列表，创建任务时和任务一起发送
+
+    @property
+    def habitica_id(self):
+        return self.instance.habitica_id if self.instance else None
+
+    def set_habitica_id(self, habitica_id, created_at=None, checklist=None):
+        """记录新的 Habitica 任务，重新创建时只更新 TaskInstance 的一行"""
+        if self.instance is None:
+            self.instance = TaskInstance()
+        self.instance.habitica_id = habitica_id
+        self.instance.created_at = created_at or datetime.utcnow()
+        self.instance.set_checklist(checklist or [])
+
+    def get_checklist(self):
+        return json.loads(self.checklist) if self.checklist else []
+
+    def set_checklist(self, texts):
+        self.checklist = json.dumps(texts, ensure_ascii=False) if texts else None
+
+    def get_series_id(self):
+        # 统计数据的键
+        return str(self.id)
 
     def get_priority_display(self):
         return _(self.PRIORITY_CHOICES[self.priority])
 
+    def get_rule_display(self):
+        return _(self.RULES[self.rule or 'completion'])
+
     def __repr__(self):
         return "<Task %s>" % self.name
 
 
+class TaskInstance(db.Model):
+    """任务模板当前在 Habitica 上的任务"""
+    __tablename__ = 'task_instance'
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True, nullable=False)
+    task_id = db.Column(db.Integer, db.ForeignKey('task.id'), nullable=False, unique=True)
+    habitica_id = db.Column(db.String(255), nullable=False, unique=True)
+    created_at = db.Column(db.DateTime)
+    checklist = db.Column(db.Text())  # Habitica 上子任务的 ID 和文本，修改时只发送变化的子任务
+
+    def get_checklist(self):
+        return json.loads(self.checklist) if self.checklist else []
+
+    def set_checklist(self, items):
+        self.checklist = json.dumps(items, ensure_ascii=False) if items else None
+
+    def __repr__(self):
+        return "<TaskInstance %s>" % self.habitica_id
+
+
 class Changelog(db.Model):
     __tablename__ = 'changelog'
     TYPES = {'feat': 'primary', 'fix': 'success', 'docs': '', 'style': 'dark', 'refactor': 'info', 'test': '',
@@ -88,3 +159,182 @@ class Notice(db.Model):
 
     def __repr__(self):
         return "<Notice %s>" % self.content
+
+
+class JobLease(db.Model):
+    """后台任务的租约，同一时间只有持有租约的实例可以运行该任务"""
+    __tablename__ = 'job_lease'
+    name = db.Column(db.String(64), primary_key=True)
+    holder = db.Column(db.String(64))
+    expires_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return "<JobLease %s>" % self.name
+
+
+class ScheduledJob(db.Model):
+    __tablename__ = 'scheduled_job'
+    __table_args__ = (
+        db.Index('ix_scheduled_job_name_finished_at', 'name', 'finished_at'),
+    )
+    STATUSES = ['running', 'succeeded', 'failed', 'lost']  # lost: 没能续租，在其他实例接管前停止
+    id = db.Column(db.String(32), primary_key=True)
+    name = db.Column(db.String(64), default='scheduled', server_default='scheduled')  # 任务类型，即租约的名称
+    status = db.Column(db.String(32), default=STATUSES[0])
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    message = db.Column(db.Text())
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'started_at': self.started_at.isoformat() + 'Z' if self.started_at else None,
+            'heartbeat_at': self.heartbeat_at.isoformat() + 'Z' if self.heartbeat_at else None,
+            'finished_at': self.finished_at.isoformat() + 'Z' if self.finished_at else None,
+            'message': self.message,
+        }
+
+    def __repr__(self):
+        return "<ScheduledJob %s>" % self.id
+
+
+class RetryItem(db.Model):
+    """失败后等待重试的 Habitica 操作，由定时任务按 next_attempt_at 取出重试"""
+    __tablename__ = 'retry_item'
+    KINDS = ['check', 'recreate', 'create', 'edit']
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True, nullable=False)
+    owner = db.Column(db.String(255), nullable=False)
+    kind = db.Column(db.String(16), nullable=False)
+    task_id = db.Column(db.Integer, db.ForeignKey('task.id', ondelete='CASCADE'))  # 任务模板的 ID，新建任务时为空
+    payload = db.Column(db.Text())  # JSON，重试需要的数据
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, index=True)
+    last_error = db.Column(db.Text())
+    created_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return "<RetryItem %s %s>" % (self.kind, self.task_id)
+
+
+class DeadLetter(db.Model):
+    """重试次数用完仍然失败的操作，管理员可以查看并重新加入重试队列"""
+    __tablename__ = 'dead_letter'
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True, nullable=False)
+    owner = db.Column(db.String(255), nullable=False)
+    kind = db.Column(db.String(16), nullable=False)
+    task_id = db.Column(db.Integer, db.ForeignKey('task.id', ondelete='CASCADE'))
+    payload = db.Column(db.Text())
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    last_error = db.Column(db.Text())
+    created_at = db.Column(db.DateTime)
+    failed_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return "<DeadLetter %s %s>" % (self.kind, self.task_id)
+
+
+class TaskEvent(db.Model):
+    """任务事件日志，只追加不修改，统计数据由它增量汇总"""
+    __tablename__ = 'task_event'
+    __table_args__ = (
+        db.Index('ix_task_event_owner_at', 'owner', 'at'),
+    )
+    KINDS = ['completed', 'recreated', 'missed']
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True, nullable=False)
+    owner = db.Column(db.String(255), nullable=False)
+    series_id = db.Column(db.String(255), nullable=False)  # 任务模板的 ID
+    kind = db.Column(db.String(16), nullable=False)
+    at = db.Column(db.DateTime, nullable=False)
+    duration = db.Column(db.Integer)  # 完成事件从创建到完成的秒数
+
+    def __repr__(self):
+        return "<TaskEvent %s %s>" % (self.kind, self.series_id)
+
+
+class TaskStat(db.Model):
+    """每个任务的累计统计"""
+    __tablename__ = 'task_stat'
+    series_id = db.Column(db.String(255), primary_key=True)  # 任务模板的 ID
+    owner = db.Column(db.String(255), nullable=False, index=True)
+    name = db.Column(db.String(255))
+    completions = db.Column(db.Integer, default=0, nullable=False)
+    recreations = db.Column(db.Integer, default=0, nullable=False)
+    misses = db.Column(db.Integer, default=0, nullable=False)
+    timed_completions = db.Column(db.Integer, default=0, nullable=False)  # 有完成耗时的完成次数
+    total_duration = db.Column(db.Integer, default=0, nullable=False)
+    current_streak = db.Column(db.Integer, default=0, nullable=False)
+    best_streak = db.Column(db.Integer, default=0, nullable=False)
+    last_completed = db.Column(db.DateTime)
+
+    def get_average_duration(self):
+        if not self.timed_completions:
+            return None
+        return self.total_duration / float(self.timed_completions)
+
+    def __repr__(self):
+        return "<TaskStat %s>" % self.name
+
+
+class StatRollup(db.Model):
+    """按天和按周汇总的完成和重新创建次数"""
+    __tablename__ = 'stat_rollup'
+    PERIODS = ['day', 'week']
+    owner = db.Column(db.String(255), primary_key=True)
+    period = db.Column(db.String(8), primary_key=True)
+    start = db.Column(db.Date, primary_key=True)  # 当天，或当周的周一
+    completions = db.Column(db.Integer, default=0, nullable=False)
+    recreations = db.Column(db.Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return "<StatRollup %s %s %s>" % (self.owner, self.period, self.start)
+
+
+class DataVersion(db.Model):
+    """数据版本号，数据每次变化时加一，用来生成页面的 ETag"""
+    __tablename__ = 'data_version'
+    key = db.Column(db.String(255), primary_key=True)
+    version = db.Column(db.Integer, default=0, nullable=False)
+
+    @staticmethod
+    def get_versions(*keys):
+        versions = dict(db.session.query(DataVersion.key, DataVersion.version).filter(DataVersion.key.in_(keys)))
+        return [versions.get(key, 0) for key in keys]
+
+    def __repr__(self):
+        return "<DataVersion %s>" % self.key
+
+
+@event.listens_for(Session, 'after_flush')
+def bump_data_versions(session, flush_context):
+    keys = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Task) and obj.owner:
+            keys.add('tasks:' + obj.owner)
+        elif isinstance(obj, TaskInstance) and obj.task is not None and obj.task.owner:
+            keys.add('tasks:' + obj.task.owner)
+        elif isinstance(obj, Changelog):
+            keys.add('changelog')
+        elif isinstance(obj, TaskEvent):
+            keys.add('stats:' + obj.owner)
+        elif isinstance(obj, User) and obj.id:
+            # 各 worker 缓存的登录用户依赖这个版本号，见 app.py 的 load_user
+            keys.add('user:' + obj.id)
+    table = DataVersion.__table__
+    dialect = session.get_bind().dialect.name
+    # 用一条 upsert 语句，两个进程同时创建同一个版本号时不会主键冲突；排序避免互相等待锁
+    for key in sorted(keys):
+        if dialect in ('sqlite', 'postgresql'):
+            insert = (sqlite if dialect == 'sqlite' else postgresql).insert(table).values(key=key, version=1)
+            session.execute(insert.on_conflict_do_update(index_elements=[table.c.key],
+                                                         set_={'version': table.c.version + 1}))
+        elif dialect == 'mysql':
+            insert = mysql.insert(table).values(key=key, version=1)
+            session.execute(insert.on_duplicate_key_update(version=table.c.version + 1))
+        else:
+            result = session.execute(table.update().where(table.c.key == key).values(version=table.c.version + 1))
+            if result.rowcount == 0:
+                session.execute(table.insert().values(key=key, version=1))
@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import DevConfig  # noqa: E402
+from extensions import db  # noqa: E402
+from app_functions.schema import sync_schema  # noqa: E402
+from app_functions.storage import init_storage  # noqa: E402
+
+
+def create_app(database_path):
+    """A bare app on its own SQLite file, without the routes of app.py."""
+    app = Flask(__name__)
+    app.config.from_object(DevConfig)
+    app.config['SQLALCHEMY_DATABASE_PATH'] = database_path
+    init_storage(app, db)
+    return app
+
+
+@pytest.fixture
+def database_path(tmp_path):
+    return str(tmp_path / 'habitica.sqlite')
+
+
+@pytest.fixture
+def empty_app(database_path):
+    """An app whose database has no tables yet."""
+    app = create_app(database_path)
+    with app.app_context():
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def app(empty_app):
+    sync_schema(db)
+    return empty_app
@@ -0,0 +1,42 @@
+from app_functions.checklist import get_checklist_diff, parse_checklist
+
+
+def items(*texts):
+    return [{'id': 'c%d' % index, 'text': text} for index, text in enumerate(texts)]
+
+
+def test_parse_checklist_skips_blank_lines():
+    assert parse_checklist(' a \n\n b\r\n  \n') == ['a', 'b']
+    assert parse_checklist(None) == []
+
+
+def test_same_checklist_needs_no_request():
+    assert get_checklist_diff(items('a', 'b'), ['a', 'b']) == ([], [], [])
+
+
+def test_reordered_checklist_needs_no_request():
+    assert get_checklist_diff(items('a', 'b', 'c'), ['c', 'a', 'b']) == ([], [], [])
+
+
+def test_changed_item_is_renamed():
+    assert get_checklist_diff(items('a', 'b', 'c'), ['a', 'x', 'c']) == ([('c1', 'x')], [], [])
+
+
+def test_extra_items_are_removed_and_missing_added():
+    assert get_checklist_diff(items('a', 'b', 'c'), ['a']) == ([], ['c1', 'c2'], [])
+    assert get_checklist_diff(items('a'), ['a', 'b', 'c']) == ([], [], ['b', 'c'])
+
+
+def test_renames_come_before_removes_and_adds():
+    assert get_checklist_diff(items('a', 'b', 'c'), ['x', 'b']) == ([('c0', 'x')], ['c2'], [])
+    assert get_checklist_diff(items('a', 'b'), ['x', 'y', 'z']) == ([('c0', 'x'), ('c1', 'y')], [], ['z'])
+
+
+def test_duplicate_texts_are_counted():
+    assert get_checklist_diff(items('a', 'a', 'b'), ['a', 'b']) == ([], ['c1'], [])
+    assert get_checklist_diff(items('a', 'b'), ['a', 'a', 'b']) == ([], [], ['a'])
+
+
+def test_empty_checklists():
+    assert get_checklist_diff([], []) == ([], [], [])
+    assert get_checklist_diff(items('a', 'b'), []) == ([], ['c0', 'c1'], [])
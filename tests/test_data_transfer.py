@@ -0,0 +1,138 @@
+import json
+from datetime import datetime
+
+from extensions import db
+from models import Tag, Task, TaskInstance
+from app_functions.data_transfer import export_user_data, import_user_data
+
+
+def ndjson(*rows):
+    return [json.dumps(row) + '\n' for row in rows]
+
+
+def task_row(habitica_id, **values):
+    row = {'type': 'task', 'habitica_id': habitica_id, 'name': 'task ' + habitica_id}
+    row.update(values)
+    return row
+
+
+def get_task(habitica_id):
+    instance = TaskInstance.query.filter_by(habitica_id=habitica_id).first()
+    return instance.task if instance else None
+
+
+def test_import_tags_and_tasks(app):
+    result = import_user_data('u1', ndjson(
+        {'type': 'tag', 'id': 'g1', 'name': 'work'},
+        task_row('h1', notes='n', priority='2.0', days=1, delay=2, checklist=['a', 'b'], tags=['g1', 'missing']),
+    ))
+
+    assert result == {'tags': 1, 'tasks': 1, 'skipped': 0}
+    task = get_task('h1')
+    assert (task.owner, task.name, task.notes, task.priority, task.days, task.delay) == ('u1', 'task h1', 'n',
+                                                                                          '2.0', 1, 2)
+    assert task.get_checklist() == ['a', 'b']
+    assert [tag.id for tag in task.tags] == ['g1']
+    assert task.rule == 'completion' and task.next_fire is None
+
+
+def test_import_skips_invalid_lines(app):
+    lines = ['not json\n', '[1, 2]\n', '\n'] + ndjson(
+        {'type': 'unknown'},
+        {'type': 'tag'},
+        {'type': 'tag', 'id': 5},
+        task_row(''),
+        {'type': 'task', 'habitica_id': 7, 'name': 'x'},
+        task_row('h1', priority='3.0'),
+        task_row('h2', days=-1),
+        task_row('h3', delay=True),
+        task_row('h4', checklist='a'),
+        task_row('h5', tags=[1]),
+        task_row('h6', name=['x']),
+    )
+
+    assert import_user_data('u1', lines) == {'tags': 0, 'tasks': 0, 'skipped': 13}
+    assert Task.query.count() == 0
+
+
+def test_import_checks_rules(app):
+    result = import_user_data('u1', ndjson(
+        task_row('h1', rule='weekly', rule_weekdays='0,2'),
+        task_row('h2', rule='weekly', rule_weekdays='01'),
+        task_row('h3', rule='weekly', rule_weekdays='7'),
+        task_row('h4', rule='weekly'),
+        task_row('h5', rule='monthly', rule_monthday=32),
+        task_row('h6', rule='interval', rule_interval=0),
+        task_row('h7', rule='interval', rule_interval=3, rule_anchor='yesterday'),
+        task_row('h8', rule='hourly'),
+        task_row('h9', rule='monthly', rule_monthday=15),
+    ))
+
+    assert result == {'tags': 0, 'tasks': 2, 'skipped': 7}
+    assert get_task('h1').rule_weekdays == '0,2'
+    assert get_task('h1').next_fire > datetime.utcnow()
+    assert get_task('h9').next_fire.day == 15
+
+
+def test_import_gives_interval_tasks_an_anchor(app):
+    import_user_data('u1', ndjson(task_row('h1', rule='interval', rule_interval=2)))
+
+    task = get_task('h1')
+    assert task.rule_anchor is not None
+    assert task.next_fire is not None
+
+
+def test_import_skips_rows_of_other_users(app):
+    db.session.add(Tag(id='g1', tag_text='theirs', tag_owner='u2'))
+    other = Task(owner='u2', name='theirs')
+    other.set_habitica_id('h1')
+    db.session.add(other)
+    db.session.commit()
+
+    result = import_user_data('u1', ndjson(
+        {'type': 'tag', 'id': 'g1', 'name': 'mine'},
+        task_row('h1', name='mine'),
+    ))
+
+    assert result == {'tags': 0, 'tasks': 0, 'skipped': 2}
+    assert Tag.query.get('g1').tag_text == 'theirs'
+    assert get_task('h1').name == 'theirs'
+
+
+def test_import_updates_existing_tasks(app):
+    import_user_data('u1', ndjson(task_row('h1', name='old', checklist=['a'])))
+    task_id = get_task('h1').id
+
+    result = import_user_data('u1', ndjson(task_row('h1', name='new')))
+
+    assert result['tasks'] == 1
+    assert Task.query.count() == 1
+    task = get_task('h1')
+    assert (task.id, task.name, task.get_checklist()) == (task_id, 'new', [])
+
+
+def test_import_accepts_legacy_ids_and_bytes(app):
+    lines = [line.encode('utf-8') for line in ndjson({'type': 'task', 'id': 'h1', 'name': '旧任务'})]
+
+    assert import_user_data('u1', lines)['tasks'] == 1
+    assert get_task('h1').name == '旧任务'
+
+
+def test_export_then_import_round_trip(app):
+    import_user_data('u1', ndjson(
+        {'type': 'tag', 'id': 'g1', 'name': 'work'},
+        task_row('h1', checklist=['a'], tags=['g1'], rule='weekly', rule_weekdays='1,3'),
+        task_row('h2'),
+    ), batch_size=1)
+    exported = list(export_user_data('u1', chunk_size=1))
+
+    db.session.execute(db.text('DELETE FROM task_tag'))
+    Task.query.delete()
+    TaskInstance.query.delete()
+    db.session.commit()
+    result = import_user_data('u1', exported)
+
+    assert result == {'tags': 1, 'tasks': 2, 'skipped': 0}
+    task = get_task('h1')
+    assert (task.get_checklist(), [tag.id for tag in task.tags]) == (['a'], ['g1'])
+    assert (task.rule, task.rule_weekdays) == ('weekly', '1,3')
@@ -0,0 +1,146 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from extensions import db
+from models import JobLease
+from app_functions import jobs
+from app_functions.jobs import (acquire_lease, check_lease, get_job_status, get_lease_holder, release_lease,
+                                renew_lease, start_job, wait_for_jobs)
+
+
+def expire_lease(name):
+    table = JobLease.__table__
+    with db.engine.begin() as connection:
+        connection.execute(table.update().where(table.c.name == name)
+                           .values(expires_at=datetime.utcnow() - timedelta(seconds=1)))
+
+
+def run_until_lease_lost(timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        check_lease()
+        time.sleep(0.02)
+    return 'lease was never lost'
+
+
+def test_lease_has_one_holder(app):
+    assert acquire_lease('scheduled', 'a', 60)
+    assert not acquire_lease('scheduled', 'b', 60)
+    assert acquire_lease('scheduled', 'a', 60)
+    assert get_lease_holder('scheduled') == 'a'
+
+
+def test_expired_lease_is_taken_over(app):
+    acquire_lease('scheduled', 'a', 60)
+    expire_lease('scheduled')
+
+    assert get_lease_holder('scheduled') is None
+    assert acquire_lease('scheduled', 'b', 60)
+    assert get_lease_holder('scheduled') == 'b'
+    # The old holder can't renew it anymore
+    assert not renew_lease('scheduled', 'a', 60)
+    assert renew_lease('scheduled', 'b', 60)
+
+
+def test_released_lease_is_free_right_away(app):
+    acquire_lease('scheduled', 'a', 60)
+    release_lease('scheduled', 'b')
+    assert not acquire_lease('scheduled', 'b', 60)
+
+    release_lease('scheduled', 'a')
+    assert acquire_lease('scheduled', 'b', 60)
+
+
+def test_leases_are_independent(app):
+    assert acquire_lease(jobs.SCHEDULED_LEASE, 'a', 60)
+    assert acquire_lease(jobs.MAINTENANCE_LEASE, 'b', 60)
+
+
+def test_check_lease_outside_a_job_does_nothing():
+    check_lease()
+
+
+def test_job_runs_and_releases_its_lease(app):
+    job_id, started = start_job(app, lambda: 'done', ttl=60, heartbeat_interval=1)
+
+    assert started
+    assert wait_for_jobs(10)
+    status = get_job_status(job_id)
+    assert (status['status'], status['message']) == ('succeeded', 'done')
+    assert get_lease_holder(jobs.SCHEDULED_LEASE) is None
+
+
+def test_second_job_is_not_started_while_one_runs(app):
+    job_id, started = start_job(app, lambda: time.sleep(0.5), ttl=60, heartbeat_interval=1)
+
+    assert started
+    assert start_job(app, lambda: None, ttl=60, heartbeat_interval=1) == (job_id, False)
+    assert wait_for_jobs(10)
+
+
+def test_failed_job_is_recorded(app):
+    def target():
+        raise ValueError('broken')
+
+    job_id, started = start_job(app, target, ttl=60, heartbeat_interval=1)
+
+    assert wait_for_jobs(10)
+    status = get_job_status(job_id)
+    assert status['status'] == 'failed' and 'ValueError' in status['message']
+
+
+def test_job_stops_after_its_lease_is_taken_over(app):
+    def target():
+        # Another instance takes over, e.g. after this one stalled
+        expire_lease(jobs.SCHEDULED_LEASE)
+        assert acquire_lease(jobs.SCHEDULED_LEASE, 'other', 60)
+        return run_until_lease_lost()
+
+    job_id, started = start_job(app, target, ttl=60, heartbeat_interval=0.1)
+
+    assert wait_for_jobs(10)
+    assert get_job_status(job_id)['status'] == 'lost'
+    # The lease stays with the new holder
+    assert get_lease_holder(jobs.SCHEDULED_LEASE) == 'other'
+
+
+def test_job_gives_up_a_lease_it_cannot_renew(app, monkeypatch):
+    def renew_fails(name, holder, ttl):
+        raise RuntimeError('database is locked')
+
+    monkeypatch.setattr(jobs, 'renew_lease', renew_fails)
+    # With a 2 s TTL the first failed heartbeat leaves less than half of it
+    job_id, started = start_job(app, run_until_lease_lost, ttl=2, heartbeat_interval=0.1)
+
+    assert wait_for_jobs(10)
+    status = get_job_status(job_id)
+    assert status['status'] == 'lost'
+    assert status['message'] == 'stopped after losing the lease'
+
+
+def test_job_keeps_a_lease_while_heartbeats_fail_briefly(app, monkeypatch):
+    failures = []
+    renew = jobs.renew_lease
+
+    def renew_fails_once(name, holder, ttl):
+        if not failures:
+            failures.append(holder)
+            raise RuntimeError('database is locked')
+        return renew(name, holder, ttl)
+
+    monkeypatch.setattr(jobs, 'renew_lease', renew_fails_once)
+    job_id, started = start_job(app, lambda: time.sleep(1), ttl=60, heartbeat_interval=0.1)
+
+    assert wait_for_jobs(10)
+    assert failures
+    assert get_job_status(job_id)['status'] == 'succeeded'
+
+
+@pytest.mark.parametrize('interval, due', [(3600, False), (0, True)])
+def test_is_job_due(app, interval, due):
+    start_job(app, lambda: None, ttl=60, heartbeat_interval=1)
+    assert wait_for_jobs(10)
+    time.sleep(0.01)
+    assert jobs.is_job_due(jobs.SCHEDULED_LEASE, interval) is due
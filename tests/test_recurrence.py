@@ -0,0 +1,66 @@
+from datetime import datetime
+
+from models import Task
+from app_functions.recurrence import (RULE_COMPLETION, RULE_INTERVAL, RULE_MONTHLY, RULE_WEEKLY, get_next_fire,
+                                      parse_weekdays)
+
+
+def make_task(rule, **values):
+    return Task(rule=rule, **values)
+
+
+def test_parse_weekdays():
+    assert parse_weekdays('4,0,2') == [0, 2, 4]
+    assert parse_weekdays('') == []
+    assert parse_weekdays(None) == []
+
+
+def test_completion_and_incomplete_rules_never_fire():
+    after = datetime(2024, 1, 10, 8)
+    assert get_next_fire(make_task(RULE_COMPLETION), after) is None
+    assert get_next_fire(make_task(RULE_WEEKLY, rule_weekdays=''), after) is None
+    assert get_next_fire(make_task(RULE_MONTHLY), after) is None
+    assert get_next_fire(make_task(RULE_INTERVAL, rule_interval=0), after) is None
+
+
+def test_weekly_fires_on_the_next_listed_day():
+    # 2024-01-10 is a Wednesday
+    task = make_task(RULE_WEEKLY, rule_weekdays='0,4')
+    assert get_next_fire(task, datetime(2024, 1, 10, 8)) == datetime(2024, 1, 12)
+    assert get_next_fire(task, datetime(2024, 1, 12, 23, 59)) == datetime(2024, 1, 15)
+
+
+def test_weekly_fires_strictly_after():
+    task = make_task(RULE_WEEKLY, rule_weekdays='2')
+    assert get_next_fire(task, datetime(2024, 1, 10)) == datetime(2024, 1, 17)
+
+
+def test_monthly_fires_on_the_day():
+    task = make_task(RULE_MONTHLY, rule_monthday=15)
+    assert get_next_fire(task, datetime(2024, 1, 10)) == datetime(2024, 1, 15)
+    assert get_next_fire(task, datetime(2024, 1, 15)) == datetime(2024, 2, 15)
+    assert get_next_fire(task, datetime(2024, 12, 20)) == datetime(2025, 1, 15)
+
+
+def test_monthly_uses_the_last_day_of_shorter_months():
+    task = make_task(RULE_MONTHLY, rule_monthday=31)
+    assert get_next_fire(task, datetime(2024, 1, 31)) == datetime(2024, 2, 29)
+    assert get_next_fire(task, datetime(2023, 1, 31)) == datetime(2023, 2, 28)
+    assert get_next_fire(task, datetime(2024, 4, 1)) == datetime(2024, 4, 30)
+
+
+def test_interval_counts_from_the_anchor():
+    task = make_task(RULE_INTERVAL, rule_interval=3, rule_anchor=datetime(2024, 1, 1, 15))
+    assert get_next_fire(task, datetime(2024, 1, 1, 20)) == datetime(2024, 1, 4)
+    assert get_next_fire(task, datetime(2024, 1, 4)) == datetime(2024, 1, 7)
+    assert get_next_fire(task, datetime(2024, 1, 5)) == datetime(2024, 1, 7)
+
+
+def test_interval_with_future_anchor_fires_on_the_anchor():
+    task = make_task(RULE_INTERVAL, rule_interval=7, rule_anchor=datetime(2024, 2, 1))
+    assert get_next_fire(task, datetime(2024, 1, 10)) == datetime(2024, 2, 1)
+
+
+def test_interval_without_anchor_starts_tomorrow():
+    task = make_task(RULE_INTERVAL, rule_interval=2)
+    assert get_next_fire(task, datetime(2024, 1, 10, 8)) == datetime(2024, 1, 11)
@@ -0,0 +1,171 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from extensions import db
+from models import DeadLetter, RetryItem, Task
+from app_functions.jobs import LeaseLost
+from app_functions.retry_queue import (RetryableError, drain, enqueue, get_backoff, get_pending_task_ids,
+                                       is_retryable, replay)
+
+NOW = datetime(2024, 1, 1)
+LATER = NOW + timedelta(days=1)
+
+
+def add_task(name='task'):
+    task = Task(owner='u1', name=name)
+    task.set_habitica_id('h-' + name)
+    db.session.add(task)
+    db.session.commit()
+    return task
+
+
+def succeed(item, payload):
+    pass
+
+
+def fail(item, payload):
+    raise RetryableError('try again')
+
+
+def crash(item, payload):
+    raise KeyError('bug')
+
+
+def test_get_backoff_doubles_up_to_the_max():
+    for attempts, delay in ((0, 300), (1, 600), (2, 1200), (10, 21600)):
+        assert delay / 2.0 <= get_backoff(attempts) <= delay
+
+
+def test_is_retryable():
+    assert is_retryable(0) and is_retryable(429) and is_retryable(502)
+    assert not is_retryable(400) and not is_retryable(404)
+
+
+def test_enqueue_is_not_due_right_away(app):
+    task = add_task()
+    item = enqueue('u1', 'check', task.id, payload={'a': 1}, error='boom', now=NOW)
+    db.session.commit()
+
+    assert (item.attempts, item.last_error, item.payload) == (0, 'boom', '{"a": 1}')
+    assert NOW + timedelta(seconds=150) <= item.next_attempt_at <= NOW + timedelta(seconds=300)
+    assert drain({'check': succeed}, now=NOW) == {'done': 0, 'retried': 0, 'dead': 0}
+
+
+def test_enqueue_adds_an_operation_on_a_task_once(app):
+    task = add_task()
+    first = enqueue('u1', 'check', task.id, now=NOW)
+    db.session.commit()
+
+    assert enqueue('u1', 'check', task.id, now=NOW) is first
+    enqueue('u1', 'edit', task.id, now=NOW)
+    enqueue('u1', 'create', payload={}, now=NOW)
+    enqueue('u1', 'create', payload={}, now=NOW)
+    db.session.commit()
+
+    assert RetryItem.query.count() == 4
+    assert get_pending_task_ids() == {task.id}
+
+
+def test_drain_deletes_done_items(app):
+    task = add_task()
+    enqueue('u1', 'check', task.id, now=NOW)
+    db.session.commit()
+
+    assert drain({'check': succeed}, now=LATER) == {'done': 1, 'retried': 0, 'dead': 0}
+    assert RetryItem.query.count() == 0
+
+
+def test_drain_backs_off_failed_items(app):
+    task = add_task()
+    enqueue('u1', 'check', task.id, now=NOW)
+    enqueue('u1', 'edit', task.id, now=NOW)
+    db.session.commit()
+
+    assert drain({'check': fail, 'edit': crash}, now=LATER) == {'done': 0, 'retried': 2, 'dead': 0}
+    check = RetryItem.query.filter_by(kind='check').one()
+    edit = RetryItem.query.filter_by(kind='edit').one()
+    assert (check.attempts, check.last_error) == (1, 'try again')
+    assert edit.attempts == 1 and 'KeyError' in edit.last_error
+    assert LATER + timedelta(seconds=300) <= check.next_attempt_at <= LATER + timedelta(seconds=600)
+    # Not due again yet
+    assert drain({'check': fail, 'edit': crash}, now=LATER) == {'done': 0, 'retried': 0, 'dead': 0}
+
+
+def test_drain_rolls_back_a_failed_handler(app):
+    task = add_task()
+    enqueue('u1', 'check', task.id, now=NOW)
+    db.session.commit()
+
+    def rename_then_fail(item, payload):
+        Task.query.get(item.task_id).name = 'changed'
+        raise RetryableError('failed after a change')
+
+    drain({'check': rename_then_fail}, now=LATER)
+    assert Task.query.get(task.id).name == 'task'
+
+
+def test_items_move_to_dead_letters_after_max_attempts(app):
+    app.config['RETRY_MAX_ATTEMPTS'] = 2
+    task = add_task()
+    enqueue('u1', 'check', task.id, payload={'a': 1}, now=NOW)
+    db.session.commit()
+
+    assert drain({'check': fail}, now=LATER)['retried'] == 1
+    assert drain({'check': fail}, now=LATER + timedelta(days=1)) == {'done': 0, 'retried': 0, 'dead': 1}
+
+    assert RetryItem.query.count() == 0
+    dead_letter = DeadLetter.query.one()
+    assert (dead_letter.kind, dead_letter.task_id, dead_letter.attempts) == ('check', task.id, 2)
+    assert (dead_letter.payload, dead_letter.last_error) == ('{"a": 1}', 'try again')
+    assert dead_letter.created_at == NOW and dead_letter.failed_at == LATER + timedelta(days=1)
+
+
+def test_replay_makes_a_dead_letter_due_again(app):
+    task = add_task()
+    db.session.add(DeadLetter(owner='u1', kind='edit', task_id=task.id, payload='{}', attempts=5,
+                              last_error='gave up', created_at=NOW, failed_at=NOW))
+    db.session.commit()
+
+    replay(DeadLetter.query.one(), now=LATER)
+    db.session.commit()
+
+    assert DeadLetter.query.count() == 0
+    item = RetryItem.query.one()
+    assert (item.kind, item.task_id, item.attempts, item.next_attempt_at) == ('edit', task.id, 0, LATER)
+    assert drain({'edit': succeed}, now=LATER)['done'] == 1
+
+
+def test_lost_lease_leaves_the_item_due(app):
+    task = add_task()
+    enqueue('u1', 'check', task.id, now=NOW)
+    db.session.commit()
+
+    def lose_lease(item, payload):
+        raise LeaseLost('lost')
+
+    with pytest.raises(LeaseLost):
+        drain({'check': lose_lease}, now=LATER)
+    item = RetryItem.query.one()
+    assert item.attempts == 0 and item.next_attempt_at < LATER
+
+
+def test_deleting_a_task_deletes_its_operations(app):
+    task = add_task()
+    other = add_task('other')
+    enqueue('u1', 'check', task.id, now=NOW)
+    enqueue('u1', 'edit', task.id, now=NOW)
+    enqueue('u1', 'edit', other.id, now=NOW)
+    db.session.add(DeadLetter(owner='u1', kind='edit', task_id=task.id))
+    db.session.commit()
+
+    def delete_task(item, payload):
+        # Like a check that got a 404
+        db.session.delete(Task.query.get(item.task_id))
+        db.session.commit()
+
+    result = drain({'check': delete_task, 'edit': delete_task}, now=LATER)
+
+    assert result['done'] == 2
+    assert RetryItem.query.count() == 0 and DeadLetter.query.count() == 0
+    assert Task.query.count() == 0
@@ -0,0 +1,100 @@
+from sqlalchemy import Integer, inspect
+
+from extensions import db
+from models import DeadLetter, RetryItem, Task, TaskInstance, task_tag
+from app_functions.schema import sync_schema
+
+# The tables as they were while tasks were keyed by their Habitica ID
+LEGACY_SCHEMA = [
+    'CREATE TABLE user (id VARCHAR(255) PRIMARY KEY, username VARCHAR(255), api_token BLOB, role VARCHAR(255))',
+    'CREATE TABLE tag (id VARCHAR(255) PRIMARY KEY, tag_text VARCHAR(255), tag_owner VARCHAR(255))',
+    'CREATE TABLE task (id VARCHAR(255) PRIMARY KEY, name VARCHAR(255), notes TEXT, priority VARCHAR(255), '
+    'days INTEGER, delay INTEGER, owner VARCHAR(255), series_id VARCHAR(255))',
+    'CREATE INDEX ix_task_name ON task (name)',
+    'CREATE TABLE task_tag (task_id VARCHAR(255), tag_id VARCHAR(255), PRIMARY KEY (task_id, tag_id))',
+    'CREATE TABLE task_event (id INTEGER PRIMARY KEY, owner VARCHAR(255) NOT NULL, series_id VARCHAR(255) NOT NULL, '
+    'kind VARCHAR(16) NOT NULL, at DATETIME NOT NULL)',
+    'CREATE TABLE retry_item (id INTEGER PRIMARY KEY, owner VARCHAR(255) NOT NULL, kind VARCHAR(16) NOT NULL, '
+    'task_id VARCHAR(255), payload TEXT, attempts INTEGER NOT NULL, next_attempt_at DATETIME NOT NULL, '
+    'last_error TEXT, created_at DATETIME)',
+    'CREATE TABLE dead_letter (id INTEGER PRIMARY KEY, owner VARCHAR(255) NOT NULL, kind VARCHAR(16) NOT NULL, '
+    'task_id VARCHAR(255), payload TEXT, attempts INTEGER NOT NULL, last_error TEXT, created_at DATETIME, '
+    'failed_at DATETIME)',
+]
+
+LEGACY_ROWS = [
+    "INSERT INTO user (id, username) VALUES ('u1', 'alice')",
+    "INSERT INTO tag (id, tag_text, tag_owner) VALUES ('g1', 'work', 'u1')",
+    # h2 is the recreation of h0, so its statistics carry h0's series ID
+    "INSERT INTO task (id, name, priority, days, delay, owner, series_id) VALUES "
+    "('h1', 'one', '1.0', 0, 0, 'u1', NULL), ('h2', 'two', '2.0', 1, 2, 'u1', 'h0')",
+    "INSERT INTO task_tag (task_id, tag_id) VALUES ('h2', 'g1')",
+    "INSERT INTO task_event (owner, series_id, kind, at) VALUES ('u1', 'h0', 'completed', '2024-01-01 00:00:00')",
+    "INSERT INTO retry_item (owner, kind, task_id, attempts, next_attempt_at) VALUES "
+    "('u1', 'edit', 'h1', 0, '2024-01-01 00:00:00'), ('u1', 'check', 'gone', 0, '2024-01-01 00:00:00'), "
+    "('u1', 'create', NULL, 0, '2024-01-01 00:00:00')",
+    "INSERT INTO dead_letter (owner, kind, task_id, attempts) VALUES ('u1', 'edit', 'h2', 5), ('u1', 'edit', 'gone', 5)",
+]
+
+
+def create_legacy_database():
+    with db.engine.begin() as connection:
+        for statement in LEGACY_SCHEMA + LEGACY_ROWS:
+            connection.exec_driver_sql(statement)
+
+
+def test_sync_schema_creates_all_tables(app):
+    assert set(db.metadata.tables) <= set(inspect(db.engine).get_table_names())
+
+
+def test_sync_schema_is_idempotent(app):
+    sync_schema(db)
+    sync_schema(db)
+
+
+def test_split_task_instances(empty_app):
+    create_legacy_database()
+    sync_schema(db)
+
+    one = TaskInstance.query.filter_by(habitica_id='h1').one().task
+    two = TaskInstance.query.filter_by(habitica_id='h2').one().task
+    assert (one.name, one.owner, one.priority) == ('one', 'u1', '1.0')
+    assert (two.name, two.days, two.delay) == ('two', 1, 2)
+    assert isinstance(one.id, int) and one.id != two.id
+    assert [tag.id for tag in two.tags] == ['g1']
+    assert one.tags == []
+
+    # Statistics follow the series to the template that replaced it
+    assert db.session.execute(db.text('SELECT series_id FROM task_event')).scalar() == str(two.id)
+
+
+def test_split_task_instances_moves_queued_operations(empty_app):
+    create_legacy_database()
+    sync_schema(db)
+
+    one = TaskInstance.query.filter_by(habitica_id='h1').one().task
+    two = TaskInstance.query.filter_by(habitica_id='h2').one().task
+    assert sorted((item.kind, item.task_id) for item in RetryItem.query) == [('create', None), ('edit', one.id)]
+    assert [(letter.kind, letter.task_id) for letter in DeadLetter.query] == [('edit', two.id)]
+
+
+def test_task_id_columns_become_foreign_keys(empty_app):
+    create_legacy_database()
+    sync_schema(db)
+
+    inspector = inspect(db.engine)
+    for table in ('retry_item', 'dead_letter'):
+        column = [column for column in inspector.get_columns(table) if column['name'] == 'task_id'][0]
+        assert isinstance(column['type'], Integer)
+        assert [key['referred_table'] for key in inspector.get_foreign_keys(table)] == ['task']
+    assert 'ix_retry_item_next_attempt_at' in {index['name'] for index in inspector.get_indexes('retry_item')}
+
+
+def test_legacy_tables_are_dropped(empty_app):
+    create_legacy_database()
+    sync_schema(db)
+
+    tables = set(inspect(db.engine).get_table_names())
+    assert not {'task_legacy', 'task_tag_legacy', 'retry_item_legacy', 'dead_letter_legacy'} & tables
+    assert Task.query.count() == 2
+    assert db.session.execute(db.select([db.func.count()]).select_from(task_tag)).scalar() == 1
@@ -1,7 +1,15 @@
 from flask_admin import AdminIndexView, expose
+from flask_admin.actions import action
 from flask_admin.contrib.sqla import ModelView
+from flask_admin.contrib.sqla.filters import FilterEqual
 from flask_login import current_user
-from flask import redirect, url_for, flash
+from sqlalchemy import and_, literal, or_, text
+from sqlalchemy.orm import selectinload
+
+from extensions import db, user_cache
+from models import User, Task, DeadLetter
+from app_functions.retry_queue import replay
+from flask import redirect, request, url_for, flash
 
 
 class MyAdminIndexView(AdminIndexView):
@@ -18,3 +26,125 @@ class MyView(ModelView):
 
     def is_accessible(self):
         return current_user.is_authenticated and current_user.role == 'admin'
+
+    def after_model_change(self, form, model, is_created):
+        if isinstance(model, User):
+            user_cache.invalidate(model.id)
+
+    def after_model_delete(self, model):
+        if isinstance(model, User):
+            user_cache.invalidate(model.id)
+
+
+class LargeTableView(MyView):
+    """大表的管理视图
+
+    搜索和 Flask-Admin 默认的包含匹配不同：整个搜索词必须是某个可搜索列的前缀，
+    这样可以用范围条件走列上的索引。例如 'job 1' 和 'job' 能找到名为 'job 1' 的任务，'ob 1' 找不到。
+    没有搜索和筛选时显示估算的总数，不执行 COUNT(*)；导出 CSV 时最多导出 export_max_rows 行。
+    """
+    can_export = True
+    export_types = ['csv']
+    export_max_rows = 10000
+    # 行数超过这个值时列表页显示估算的总数
+    estimated_count_threshold = 100000
+
+    def get_estimated_count(self):
+        """从 ANALYZE 的统计信息估算行数，没有统计信息时使用最大的 rowid"""
+        if db.engine.dialect.name != 'sqlite':
+            return None
+        table = self.model.__tablename__
+        stat = None
+        if self._has_sqlite_stat():
+            stat = self.session.execute(
+                text('SELECT stat FROM sqlite_stat1 WHERE tbl = :tbl LIMIT 1'), {'tbl': table}
+            ).scalar()
+        if stat:
+            return int(stat.split(' ')[0])
+        return self.session.execute(text('SELECT max(rowid) FROM "%s"' % table)).scalar() or 0
+
+    def _has_sqlite_stat(self):
+        return self.session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+        ).scalar() is not None
+
+    def get_prefix_filter(self):
+        """搜索词的前缀条件，没有搜索时返回 None
+
+        Flask-Admin 仍然会加上它自己的 ILIKE 条件，但只需要检查范围条件选出的行。
+        """
+        search = request.args.get('search', '').strip()
+        if not search or not self.column_searchable_list:
+            return None
+        columns = [getattr(self.model, name) for name in self.column_searchable_list]
+        return or_(*[and_(column >= search, column < search + u'\U0010ffff') for column in columns])
+
+    def get_query(self):
+        query = super(LargeTableView, self).get_query()
+        prefix_filter = self.get_prefix_filter()
+        return query if prefix_filter is None else query.filter(prefix_filter)
+
+    def get_count_query(self):
+        prefix_filter = self.get_prefix_filter()
+        if prefix_filter is not None:
+            return super(LargeTableView, self).get_count_query().filter(prefix_filter)
+        if not any(key.startswith('flt') for key in request.args):
+            estimated_count = self.get_estimated_count()
+            if estimated_count is not None and estimated_count >= self.estimated_count_threshold:
+                return self.session.query(literal(estimated_count))
+        return super(LargeTableView, self).get_count_query()
+
+
+class UserView(LargeTableView):
+    column_list = ('id', 'username', 'role', 'language')
+    column_searchable_list = ('id', 'username')
+    column_filters = (FilterEqual(User.role, '角色', options=[(role, role) for role in User.ROLES]),)
+
+
+class TaskView(LargeTableView):
+    column_list = ('id', 'instance', 'name', 'owner', 'priority', 'days', 'delay', 'tags')
+    column_labels = {'instance': 'Habitica ID'}
+    # 标签在 get_query 中用 selectinload 加载，不使用 Flask-Admin 默认的 joinedload
+    column_auto_select_related = False
+    column_searchable_list = ('name', 'owner')
+    column_filters = (
+        FilterEqual(Task.owner, '所有者'),
+        FilterEqual(Task.priority, '难度', options=list(Task.PRIORITY_CHOICES.items())),
+    )
+    column_formatters = {
+        'tags': lambda view, context, model, name: ', '.join(tag.tag_text or '' for tag in model.tags),
+        'instance': lambda view, context, model, name: model.habitica_id or '',
+    }
+    column_formatters_export = column_formatters
+    # 重试队列由定时任务维护，不在任务表单中编辑
+    form_excluded_columns = ('retry_items', 'dead_letters')
+
+    def get_query(self):
+        # 一次查询加载当前页所有任务的标签
+        return super(TaskView, self).get_query().options(selectinload(Task.tags))
+
+
+class RetryItemView(MyView):
+    """等待重试的 Habitica 操作，只能查看和删除"""
+    can_create = False
+    can_edit = False
+    column_list = ('kind', 'owner', 'task_id', 'attempts', 'next_attempt_at', 'last_error', 'created_at')
+    column_default_sort = 'next_attempt_at'
+    column_filters = ('kind', 'owner')
+
+
+class DeadLetterView(MyView):
+    """重试次数用完的操作，可以重新加入重试队列"""
+    can_create = False
+    can_edit = False
+    column_list = ('kind', 'owner', 'task_id', 'attempts', 'last_error', 'created_at', 'failed_at')
+    column_default_sort = ('failed_at', True)
+    column_filters = ('kind', 'owner')
+
+    @action('replay', '重新加入重试队列', '确定要把选中的任务重新加入重试队列吗？')
+    def action_replay(self, ids):
+        dead_letters = DeadLetter.query.filter(DeadLetter.id.in_(ids)).all()
+        for dead_letter in dead_letters:
+            replay(dead_letter)
+        db.session.commit()
+        flash('%d 个任务已重新加入重试队列，下次定时任务运行时会重试' % len(dead_letters))